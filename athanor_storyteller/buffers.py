@@ -0,0 +1,177 @@
+import time
+
+from django.conf import settings
+from django.db import transaction
+from twisted.internet import reactor, task
+
+from evennia.utils.logger import log_err, log_trace
+
+
+class BatchBuffer(object):
+    """
+    Base for in-memory buffers that are drained in one batch: on a timer, as soon as
+    they hold threshold entries, and before the reactor shuts down (which includes
+    server reloads). Subclasses implement __len__ and _flush().
+
+    A failed flush keeps the entries and backs off, doubling the wait up to
+    max_backoff seconds, so a database that stays down isn't hit (and logged) on
+    every change. If limit_setting is set, trim() is asked to shed anything past that
+    many entries, and abandon() gets whatever the last flush at shutdown couldn't write.
+    """
+    interval_setting = None
+    threshold_setting = None
+    limit_setting = None
+    default_interval = 10
+    default_threshold = 500
+    default_limit = None
+    max_backoff = 300
+
+    def __init__(self):
+        self.timer = None
+        self.hooked = False
+        self.failures = 0
+        self.retry_at = 0
+
+    @property
+    def interval(self):
+        return getattr(settings, self.interval_setting, self.default_interval)
+
+    @property
+    def threshold(self):
+        return getattr(settings, self.threshold_setting, self.default_threshold)
+
+    @property
+    def limit(self):
+        return getattr(settings, self.limit_setting, self.default_limit) if self.limit_setting else None
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def start(self):
+        if not self.hooked:
+            reactor.addSystemEventTrigger('before', 'shutdown', self.shutdown)
+            self.hooked = True
+        if not self.timer:
+            self.timer = task.LoopingCall(self.flush)
+            self.timer.start(self.interval, now=False)
+
+    def check(self):
+        self.start()
+        if (limit := self.limit) and len(self) > limit:
+            self.trim(len(self) - limit)
+        if len(self) >= self.threshold:
+            self.flush()
+
+    def flush(self, force=False):
+        """
+        Write out everything buffered. Returns False if entries remain, either because
+        this attempt failed or because an earlier failure's backoff hasn't run out.
+        """
+        if not len(self):
+            return True
+        if not force and time.monotonic() < self.retry_at:
+            return False
+        try:
+            self._flush()
+        except Exception:
+            log_trace()
+            self.failures += 1
+            self.retry_at = time.monotonic() + min(self.interval * 2 ** self.failures, self.max_backoff)
+            return False
+        self.failures, self.retry_at = 0, 0
+        return True
+
+    def shutdown(self):
+        if not self.flush(force=True):
+            self.abandon()
+
+    def _flush(self):
+        raise NotImplementedError
+
+    def trim(self, count):
+        pass
+
+    def abandon(self):
+        pass
+
+
+class WriteBehindBuffer(BatchBuffer):
+    """
+    Coalesces saves of Traits and Pools. Each dirty instance is remembered once along
+    with the fields that changed; because the instance itself is held (and is the one
+    the idmapper hands out), anything reading it sees the pending values, and a flush
+    writes whatever the last value was. Flushes group instances by model and field set
+    and bulk_update each group inside a single transaction.
+
+    Off unless settings.STORYTELLER_WRITE_BEHIND is True; then save() is a plain save.
+    """
+    interval_setting = 'STORYTELLER_WRITE_BEHIND_INTERVAL'
+    threshold_setting = 'STORYTELLER_WRITE_BEHIND_THRESHOLD'
+    default_interval = 5
+    default_threshold = 200
+
+    def __init__(self):
+        super().__init__()
+        self.dirty = dict()
+
+    def __len__(self):
+        return len(self.dirty)
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'STORYTELLER_WRITE_BEHIND', False)
+
+    def save(self, obj, *fields):
+        if not self.enabled or obj.pk is None:
+            obj.save(update_fields=list(fields))
+            return
+        key = (obj._meta.concrete_model, obj.pk)
+        if (found := self.dirty.get(key, None)):
+            found[1].update(fields)
+        else:
+            self.dirty[key] = (obj, set(fields))
+        self.check()
+
+    def is_dirty(self, obj):
+        return (obj._meta.concrete_model, obj.pk) in self.dirty
+
+    def discard(self, obj):
+        self.dirty.pop((obj._meta.concrete_model, obj.pk), None)
+
+    def fields(self, obj):
+        """
+        The fields obj is waiting to write, so a caller about to save obj itself can
+        include them. The entry stays queued in case the caller's transaction fails.
+        """
+        return set(found[1]) if (found := self.dirty.get((obj._meta.concrete_model, obj.pk), None)) else set()
+
+    def _flush(self):
+        pending, self.dirty = self.dirty, dict()
+        groups = dict()
+        for (model, pk), (obj, fields) in pending.items():
+            groups.setdefault((model, frozenset(fields)), list()).append(obj)
+        try:
+            with transaction.atomic():
+                for (model, fields), objs in groups.items():
+                    model.objects.bulk_update(objs, list(fields))
+        except Exception:
+            # Keep the changes for the next attempt, without clobbering anything newer.
+            for key, (obj, fields) in pending.items():
+                if (found := self.dirty.get(key, None)):
+                    found[1].update(fields)
+                else:
+                    self.dirty[key] = (obj, fields)
+            raise
+
+    def abandon(self):
+        # The server is going down: save one instance at a time and log whatever still won't go.
+        pending, self.dirty = self.dirty, dict()
+        for (model, pk), (obj, fields) in pending.items():
+            try:
+                obj.save(update_fields=list(fields))
+            except Exception:
+                log_err(f"Could not save {model.__name__} {pk}: " +
+                        ', '.join(f"{field}={getattr(obj, field)!r}" for field in sorted(fields)))
+
+
+WRITE_BEHIND = WriteBehindBuffer()
@@ -0,0 +1,117 @@
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from evennia.utils.logger import log_trace
+
+from athanor_storyteller.buffers import WRITE_BEHIND
+
+
+class PersonaCache(object):
+    """
+    LRU policy for the Traits and Pools the idmapper holds on behalf of Personas.
+
+    Reading a Persona's sheet touches it. sweep() (run on a ticker) evicts the Traits
+    and Pools, and drops the sheet, bonus and rendering state, of every Persona idle
+    for longer than settings.STORYTELLER_CACHE_IDLE seconds, then of the least recently
+    used Personas until at most settings.STORYTELLER_CACHE_SIZE remain. Personas of
+    puppeted Characters are pinned and never evicted, and nothing with a pending
+    write-behind save is evicted until that save lands.
+    """
+
+    def __init__(self):
+        self.touched = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_objects = 0
+
+    @property
+    def idle(self):
+        return getattr(settings, 'STORYTELLER_CACHE_IDLE', 900)
+
+    @property
+    def size(self):
+        return getattr(settings, 'STORYTELLER_CACHE_SIZE', 500)
+
+    def touch(self, persona):
+        self.touched[persona.id] = (time.monotonic(), persona.db_object_id)
+        self.touched.move_to_end(persona.id)
+
+    def hit(self, persona):
+        self.hits += 1
+        self.touch(persona)
+
+    def miss(self, persona):
+        self.misses += 1
+        self.touch(persona)
+
+    def forget(self, persona):
+        self.touched.pop(persona.id, None)
+
+    def stats(self):
+        return {'tracked': len(self.touched), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'evicted_objects': self.evicted_objects}
+
+    def pinned_objects(self):
+        from evennia.server.sessionhandler import SESSION_HANDLER
+        return {puppet.id for session in SESSION_HANDLER.values() if (puppet := session.puppet)}
+
+    def select(self):
+        """
+        Returns the ids of the Personas to evict, least recently used first.
+        """
+        pinned = self.pinned_objects()
+        unpinned = [(persona_id, touched) for persona_id, (touched, obj_id) in self.touched.items()
+                    if obj_id not in pinned]
+        excess = len(unpinned) - self.size
+        cutoff = time.monotonic() - self.idle
+        found = list()
+        for persona_id, touched in unpinned:
+            if excess <= 0 and touched > cutoff:
+                break
+            found.append(persona_id)
+            excess -= 1
+        return found, pinned
+
+    def sweep(self):
+        from athanor_storyteller.models import PersonaDB, TraitDB, PoolDB
+        try:
+            evict, pinned = self.select()
+            WRITE_BEHIND.flush()
+            evict = set(evict)
+            # Traits and Pools nobody has touched the sheet of (say, loaded by a staff
+            # command) are idle by definition, unless their Character is puppeted.
+            keep = {persona_id for persona_id, (touched, obj_id) in self.touched.items() if persona_id not in evict}
+            for model in (TraitDB, PoolDB):
+                for found in model.get_all_cached_instances():
+                    if found.db_persona_id in keep or WRITE_BEHIND.is_dirty(found):
+                        continue
+                    if found.db_persona_id not in evict and (persona := PersonaDB.get_cached_instance(found.db_persona_id)) \
+                            and persona.db_object_id in pinned:
+                        continue
+                    found.flush_from_cache(force=True)
+                    self.evicted_objects += 1
+            for persona_id in evict:
+                del self.touched[persona_id]
+                if not (persona := PersonaDB.get_cached_instance(persona_id)):
+                    continue
+                getattr(persona, '_prefetched_objects_cache', dict()).clear()
+                for handler in ('sheet', 'bonuses'):
+                    if (found := persona.__dict__.get(handler, None)):
+                        found.release()
+                if (found := persona.__dict__.get('renderer', None)):
+                    found.clear()
+            self.evictions += len(evict)
+        except Exception:
+            log_trace()
+
+
+CACHE = PersonaCache()
+
+
+def sweep_persona_cache():
+    """
+    Ticker entry point; the TickerHandler can't call methods of plain objects.
+    """
+    CACHE.sweep()
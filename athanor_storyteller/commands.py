@@ -0,0 +1,58 @@
+from evennia.commands.default.muxcommand import MuxCommand
+from evennia.utils.evtable import EvTable
+
+from athanor_storyteller.cache import CACHE
+from athanor_storyteller.instrumentation import METRICS
+
+
+class CmdStorytellerStats(MuxCommand):
+    """
+    Show how storyteller operations are performing.
+
+    Usage:
+        +ststats
+        +ststats/on
+        +ststats/off
+        +ststats/reset
+        +ststats/export
+
+    With no switch, lists wall time, database queries and persona cache use of
+    the recent calls of each instrumented operation. /on and /off toggle the
+    measurements until the next reload, /reset discards them, and /export writes
+    them to the storyteller metrics log as JSON lines.
+    """
+    key = '+ststats'
+    locks = 'cmd:perm(Admin)'
+    help_category = 'Admin'
+    switch_options = ('on', 'off', 'reset', 'export')
+
+    def func(self):
+        if 'on' in self.switches:
+            METRICS.enable()
+            return self.msg("Storyteller instrumentation enabled.")
+        if 'off' in self.switches:
+            METRICS.disable()
+            return self.msg("Storyteller instrumentation disabled.")
+        if 'reset' in self.switches:
+            METRICS.reset()
+            return self.msg("Storyteller metrics cleared.")
+        if 'export' in self.switches:
+            count = METRICS.export()
+            return self.msg(f"Exported {count} operation summaries to {METRICS.log_name}.")
+
+        state = 'on' if METRICS.check() else 'off'
+        cache = CACHE.stats()
+        lines = [f"Instrumentation is {state}. Persona cache: {cache['tracked']} tracked, {cache['hits']} hits, "
+                 f"{cache['misses']} misses, {cache['evictions']} evictions ({cache['evicted_objects']} objects)."]
+        if (summaries := METRICS.summaries()):
+            table = EvTable('Operation', 'Calls', 'Mean ms', 'p95 ms', 'Max ms', 'Queries', 'p95 Q', 'Hits', 'Misses',
+                            border='cells')
+            for summary in summaries:
+                wall, queries, cache = summary['wall_ms'], summary['queries'], summary['cache']
+                table.add_row(summary['name'], summary['calls'], f"{wall['mean']:.2f}", f"{wall['p95']:.2f}",
+                              f"{wall['max']:.2f}", f"{queries['mean']:.1f}", queries['p95'], cache['hits'],
+                              cache['misses'])
+            lines.append(str(table))
+        else:
+            lines.append("Nothing has been measured yet.")
+        self.msg('\n'.join(lines))
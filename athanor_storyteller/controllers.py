@@ -4,12 +4,23 @@ from django.conf import settings
 from evennia.utils.logger import log_trace
 from evennia.utils.utils import class_from_module
 from evennia.utils.ansi import ANSIString
+from evennia.scripts.tickerhandler import TICKER_HANDLER
 
 from athanor.utils.text import partial_match
 from athanor.controllers.base import AthanorController
 from athanor.utils.time import utcnow
 
+from athanor_storyteller.models import StorySystem
 from athanor_storyteller.gamedb import DefaultTrait, DefaultTraitDefinition, DefaultPersona
+from athanor_storyteller.importer import DefinitionImporter
+from athanor_storyteller.registry import TYPECLASSES
+from athanor_storyteller.indexes import PersonaDirectory
+from athanor_storyteller.pools import regenerate_pools
+from athanor_storyteller.cache import CACHE, sweep_persona_cache
+from athanor_storyteller.instrumentation import instrumented
+from athanor_storyteller.queries import TraitQuery
+from athanor_storyteller.journal import JOURNAL
+from athanor_storyteller.models import TraitJournalDB
 from athanor_storyteller import messages as smsg
 
 
@@ -18,6 +29,7 @@ class AthanorPersonaController( AthanorController):
 
     def do_load(self):
         from django.conf import settings
+        self.directory = PersonaDirectory()
 
         try:
             persona_typeclass = settings.PERSONA_TYPECLASS
@@ -40,39 +52,107 @@ class AthanorPersonaController( AthanorController):
             log_trace()
             self.trait_typeclass = DefaultTrait
 
+        # Hand the resolved classes to the registry so that Definitions without an override
+        # fall back to them and never re-import the same paths.
+        TYPECLASSES.register(getattr(settings, 'PERSONA_TYPECLASS', None), self.persona_typeclass)
+        TYPECLASSES.register(getattr(settings, 'TRAIT_DEFINITION_TYPECLASS', None), self.definition_typeclass)
+        TYPECLASSES.register(getattr(settings, 'TRAIT_TYPECLASS', None), self.trait_typeclass)
+        TYPECLASSES.default_definition = self.definition_typeclass
+        TYPECLASSES.default_trait = self.trait_typeclass
+        TYPECLASSES.clear()
+        self.load_definitions()
+
+        TICKER_HANDLER.add(getattr(settings, 'STORYTELLER_POOL_TICK', 60), regenerate_pools,
+                           idstring='storyteller_pools', persistent=False)
+        TICKER_HANDLER.add(getattr(settings, 'STORYTELLER_CACHE_TICK', 60), sweep_persona_cache,
+                           idstring='storyteller_cache', persistent=False)
+
+    def load_definitions(self):
+        """
+        Build every system's definition index up front (from its snapshot when current)
+        and import each typeclass the definitions name.
+        """
+        paths = set()
+        for system in StorySystem.objects.all():
+            system.definitions.load()
+            for entry in system.definitions.entries.values():
+                paths.update(path for path in (entry.typeclass_path, entry.trait_typeclass, entry.child_typeclass) if path)
+        for path in paths:
+            try:
+                TYPECLASSES.load_class(path)
+            except Exception:
+                log_trace()
+
     def get_user(self, session):
         return session.get_account()
 
-    def create_persona(self, session, character, name, typeclass=None):
+    def find_system(self, system):
+        if isinstance(system, StorySystem):
+            return system
+        if not system:
+            raise ValueError("Nothing entered for Story System!")
+        if not (found := StorySystem.objects.filter(db_key__iexact=system).first()):
+            raise ValueError(f"Story System '{system}' not found!")
+        return found
+
+    def import_definitions(self, session, system, stream, format='json'):
+        """
+        Bulk-load a TraitDefinition tree from a file-like object. See DefinitionImporter.
+        """
+        if not (enactor := self.get_user(session)):
+            raise ValueError("Permission denied!")
+        importer = DefinitionImporter(self.find_system(system))
+        return importer.run(importer.read(stream, format))
+
+    @instrumented('controller.create_persona')
+    def create_persona(self, session, character, system, name, typeclass=None):
         if not (enactor := self.get_user(session)):
             raise ValueError("Permission denied!")
         character = self.manager.get('character').find_character(character)
+        system = self.find_system(system)
         if not typeclass:
             typeclass = self.persona_typeclass
-        new_persona = typeclass.create(character, name)
-        entities = {'enactor': enactor, 'target': new_persona}
-        smsg.Create(entities).send()
+        with smsg.collect():
+            new_persona = typeclass.create(character, system, name)
+            self.directory.add(new_persona)
+            entities = {'enactor': enactor, 'target': new_persona}
+            smsg.Create(entities).send()
         return new_persona
 
-    def find_persona(self, persona):
+    @instrumented('controller.find_persona')
+    def find_persona(self, persona, system=None):
+        """
+        Finds a Persona addressed as <character>/<persona>, or <character>/<system>/<persona>
+        when a character has like-named Personas in several Story Systems.
+        """
         if isinstance(persona, DefaultPersona):
             return persona
         if '/' not in persona:
-            raise ValueError("Must address persona by <character>/<persona>")
+            raise ValueError("Must address persona by <character>/<persona> or <character>/<system>/<persona>")
         character, persona = persona.split('/', 1)
+        if '/' in persona:
+            system, persona = persona.split('/', 1)
+        if system:
+            system = self.find_system(system.strip() if isinstance(system, str) else system)
         character = self.manager.get('character').find_character(character)
-        if not (candidates := DefaultPersona.objects.filter_family(db_character=character)):
+        if not self.directory.count(character):
             raise ValueError(f"No Personas for {character}!")
-        if not (found := partial_match(category, candidates)):
+        if not (found := self.directory.find(character, persona.strip(), system)):
             raise ValueError(f"Persona '{persona}' not found!")
-        return found
+        if len(found) > 1:
+            names = ', '.join(f"{found_persona} ({found_persona.db_system.db_key})" for found_persona in
+                              (self.directory.get_persona(persona_id) for persona_id in found))
+            raise ValueError(f"That matched {names}. Please be more exact, or name the system!")
+        return self.directory.get_persona(found[0])
 
     def rename_persona(self, session, persona, new_name=None):
         if not (enactor := self.get_user(session)) and self.parent_operator(enactor):
             raise ValueError("Permission denied!")
         persona = self.find_persona(persona)
         old_name = persona.key
+        old_ikey = persona.db_ikey
         new_name = persona.rename(new_name)
+        self.directory.rename(persona, old_ikey)
         entities = {'enactor': enactor, 'target': persona}
         smsg.Rename(entities, old_name=old_name).send()
 
@@ -81,68 +161,173 @@ class AthanorPersonaController( AthanorController):
             raise ValueError("Permission denied!")
         persona = self.find_persona(persona)
         entities = {'enactor': enactor, 'target': persona}
-        smsg.Delete(entities).send()
-        persona.delete()
+        with smsg.collect():
+            smsg.Delete(entities).send()
+            self.directory.remove(persona)
+            with JOURNAL.acting(enactor):
+                JOURNAL.record(persona, None, persona.key, None, None, TraitJournalDB.KIND_DELETE)
+            CACHE.forget(persona)
+            persona.delete()
+
+    def sheet_history(self, session, persona, when):
+        """
+        Rebuild a Persona's sheet as of a past datetime. persona may be a raw id, so
+        deleted Personas can still be audited.
+
+        Returns:
+            sheet (list): (fullpath, context, base value, damage value) tuples, sorted.
+        """
+        if not (enactor := self.get_user(session)):
+            raise ValueError("Permission denied!")
+        if isinstance(persona, int):
+            persona_id = persona
+            index = None
+        else:
+            persona = self.find_persona(persona)
+            persona_id = persona.id
+            index = persona.db_system.definitions
+        output = list()
+        for def_id, context, base, damage in JOURNAL.sheet_at(persona_id, when):
+            entry = index.get(def_id) if index else None
+            output.append((index.fullpath(entry) if entry else f"#{def_id}", context, base, damage))
+        return sorted(output)
 
     def find_template(self, template):
         if not template:
             raise ValueError("Nothing entered for Template!")
-        if isinstance(template, DefaultPersona):
+        if isinstance(template, type) and issubclass(template, DefaultPersona):
             return template
         if not (found := partial_match(template, settings.STORYTELLER_TEMPLATES.keys())):
             raise ValueError(f"No template {template}")
-        return settings.STORYTELLER_TEMPLATES[found]
+        if isinstance(found := settings.STORYTELLER_TEMPLATES[found], str):
+            found = TYPECLASSES.load_class(found)
+        return found
 
+    @instrumented('controller.change_template')
     def change_template(self, session, persona, template):
         if not (enactor := self.get_user(session)):
             raise ValueError("Permission denied!")
         persona = self.find_persona(persona)
         old_template = persona.__class__
         template = self.find_template(template)
-        persona.change_template(template)
-        entities = {'enactor': enactor, 'target': persona}
-        smsg.Template(entities, old_template=old_template)
+        with smsg.collect(), JOURNAL.acting(enactor):
+            persona.change_template(template)
+            entities = {'enactor': enactor, 'target': persona}
+            smsg.Template(entities, old_template=old_template.__name__, template=template.__name__).send()
 
-    def parse_trait(self, trait):
+    @instrumented('controller.parse_trait')
+    def parse_trait(self, system, trait):
         if ':' in trait:
             path, context = trait.split(':', 1)
             path = path.strip()
             context = context.strip()
         else:
-            path = trait
+            path = trait.strip()
             context = ''
+        index = system.definitions
         if '/' in path:
-            path = [stripped for p in path.split('/') if (stripped := p.strip())]
+            found = None
+            searched = list()
+            for entry in [stripped for p in path.split('/') if (stripped := p.strip())]:
+                searched.append(entry)
+                if not (found := index.find_child(found, entry)):
+                    raise ValueError(f"Cannot locate trait: {'/'.join(searched)}")
+            if not found:
+                raise ValueError("Nothing entered for trait!")
         else:
-            if not (found := DefaultTraitDefinition.objects.filter_family(db_key__iexact=path).order_by('db_key')):
-                if not (found := DefaultTraitDefinition.objects.filter_family(db_key__istartswith=path).order_by('db_key')):
-                    if not (found := DefaultTraitDefinition.objects.filter_family(db_key__icontains=path).order_by('db_key')):
-                        raise ValueError(f"Cannot quick-find trait: {path}. Please use full path searching with /")
-            if len(found) > 1:
-                raise ValueError(f"That matched {', '.join(t.fullpath() for t in found)}. Please be more exact or use full-path searching with /")
-            return (found[0], context)
-        trait = None
-        searched = list()
-        for entry in path:
-            searched.append(entry)
-            candidates = DefaultTraitDefinition.objects.filter_family(db_parent=None)
-            if not (found := partial_match(entry, candidates)):
-                raise ValueError(f"Cannot locate trait: {'/'.join(searched)}")
-            trait = found
+            if not (candidates := index.quick_find(path)):
+                raise ValueError(f"Cannot quick-find trait: {path}. Please use full path searching with /")
+            if len(candidates) > 1:
+                raise ValueError(f"That matched {', '.join(index.fullpath(t) for t in candidates)}. Please be more exact or use full-path searching with /")
+            found = candidates[0]
+        trait = index.get_definition(found)
         if context and not trait.db_allow_context:
             raise ValueError(f"{trait} does not allow Contexts!")
         if trait.db_require_context and not context:
             raise ValueError(f"{trait} requires a Context!")
         return (trait, context)
 
+    def query_traits(self, session, system, criteria, page_size=100):
+        """
+        Find Personas in a system meeting every criterion, e.g. ['Occult>=4', 'Melee: Swords'].
+        Returns a generator of pages of rows; see TraitQuery.
+        """
+        if not (enactor := self.get_user(session)):
+            raise ValueError("Permission denied!")
+        system = self.find_system(system)
+        return TraitQuery(system, criteria, self.parse_trait).pages(page_size)
+
+    def render_sheet(self, session, persona, sections=None, width=78):
+        """
+        Renders a Persona's sheet, optionally limited to some top-level categories by name.
+        """
+        if not (enactor := self.get_user(session)):
+            raise ValueError("Permission denied!")
+        persona = self.find_persona(persona)
+        if sections:
+            index = persona.db_system.definitions
+            roots = list()
+            for name in sections:
+                if not (found := index.find_child(None, name)):
+                    raise ValueError(f"No sheet section called {name}!")
+                roots.append(found)
+            sections = roots
+        return persona.renderer.render(sections, width)
+
     def find_trait(self, persona, trait):
         if not trait:
             raise ValueError("Nothing entered for trait!")
-        match = self.re_trait(trait).groupdict()
+        return self.parse_trait(persona.db_system, trait)
 
+    def trait_costs(self, session, persona, entries):
+        """
+        Experience cost of a proposed batch of (trait, value) pairs, without setting anything.
+        """
+        if not (enactor := self.get_user(session)):
+            raise ValueError("Permission denied!")
+        persona = self.find_persona(persona)
+        parsed = list()
+        for trait, value in entries:
+            definition, context = self.find_trait(persona, trait)
+            parsed.append((definition, context, value))
+        return persona.experience_cost(parsed)
+
+    def audit_costs(self, session, system):
+        """
+        Returns {persona id: sheet cost} for every Persona in a StorySystem.
+        """
+        if not (enactor := self.get_user(session)):
+            raise ValueError("Permission denied!")
+        return self.find_system(system).costs.audit()
+
+    @instrumented('controller.set_trait_value')
     def set_trait_value(self, session, persona, trait, value):
+        return self.set_trait_values(session, persona, [(trait, value)])[0]
+
+    @instrumented('controller.set_trait_values')
+    def set_trait_values(self, session, persona, entries):
+        """
+        Sets many traits on one Persona in a single transaction. entries is an iterable
+        of (trait, value) pairs where trait is anything find_trait accepts, such as
+        'Abilities/Melee: Swords'. Every trait is resolved before anything is written.
+        """
         if not (enactor := self.get_user(session)):
             raise ValueError("Permission denied!")
         persona = self.find_persona(persona)
-        trait, context = self.find_trait(persona, trait)
-        persona.set_trait_value(trait, context, value)
\ No newline at end of file
+        parsed = list()
+        errors = list()
+        for trait, value in entries:
+            try:
+                definition, context = self.find_trait(persona, trait)
+                parsed.append((definition, context, value))
+            except ValueError as err:
+                errors.append(str(err))
+        if errors:
+            raise ValueError('\n'.join(errors))
+        with smsg.collect(), JOURNAL.acting(enactor):
+            results = persona.set_trait_values(parsed)
+            entities = {'enactor': enactor, 'target': persona}
+            for (definition, context, value), result in zip(parsed, results):
+                trait = f"{definition.fullpath()}: {context}" if context else definition.fullpath()
+                smsg.TraitSet(entities, trait=trait, value=value if result else 'removed').send()
+        return results
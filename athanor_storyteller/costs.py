@@ -0,0 +1,174 @@
+"""
+Experience costs for raising Traits.
+
+A cost rule is a JSON object stored on a TraitDefinition (db_cost_rule) and inherited
+by every descendant that has none of its own. A Persona template may override rules
+through its cost_rules class attribute, keyed the same way as template_traits. The
+cost of the dot that takes a Trait from rating v - 1 to v is:
+
+    table[v - 1]                            if the rule has a 'table' that long
+    first                                   if v == 1 and the rule has 'first'
+    multiplier * (v - 1) + flat             with 'base': 'current' (the default)
+    multiplier * v + flat                   with 'base': 'new'
+
+Every distinct rule is expanded once into a cumulative row of a NumPy matrix, and each
+Definition maps to its row, so costing a batch, a sheet, or every Persona in a system
+is a single fancy-indexing pass.
+"""
+import numpy as np
+
+DEFAULT_WIDTH = 11
+
+
+def dot_costs(rule, width):
+    """
+    Per-dot costs of a rule: element v is the cost of going from v - 1 to v (element 0 is 0).
+    """
+    dots = np.arange(width, dtype=np.int64)
+    base = dots - 1 if rule.get('base', 'current') == 'current' else dots
+    costs = int(rule.get('multiplier', 0)) * base + int(rule.get('flat', 0))
+    if 'first' in rule and width > 1:
+        costs[1] = int(rule['first'])
+    if (table := rule.get('table', None)):
+        table = np.asarray(table[:width - 1], dtype=np.int64)
+        costs[1:len(table) + 1] = table
+    costs[0] = 0
+    return costs
+
+
+class CostTable(object):
+    """
+    Cumulative costs for one template in one StorySystem. cumulative[row, v] is the total
+    cost of buying a Trait from 0 to v; rows[def_id] is the row of a Definition, and row
+    0 (no rule anywhere up the tree) costs nothing.
+    """
+
+    def __init__(self, index, overrides, width=DEFAULT_WIDTH):
+        self.index = index
+        self.overrides = overrides
+        self.width = width
+        self.rows = dict()
+        self.cumulative = None
+        self.build()
+
+    def resolve(self, entry):
+        while entry:
+            if (rule := self.overrides.get(entry.id, None)) is not None:
+                return rule
+            if entry.cost_rule is not None:
+                return entry.cost_rule
+            entry = self.index.get(entry.parent_id) if entry.parent_id else None
+        return None
+
+    def build(self):
+        rules = {None: 0}
+        matrix = [np.zeros(self.width, dtype=np.int64)]
+        for entry in self.index.entries.values():
+            rule = self.resolve(entry)
+            key = None if rule is None else repr(sorted(rule.items()))
+            if (row := rules.get(key, None)) is None:
+                row = len(matrix)
+                rules[key] = row
+                matrix.append(np.cumsum(dot_costs(rule, self.width)))
+            self.rows[entry.id] = row
+        self.cumulative = np.vstack(matrix)
+
+    def ensure(self, highest):
+        if highest >= self.width:
+            self.width = int(highest) + 1
+            self.rows = dict()
+            self.build()
+
+    def lookup(self, def_ids):
+        return np.fromiter((self.rows.get(def_id, 0) for def_id in def_ids), dtype=np.int64, count=len(def_ids))
+
+    def total(self, def_ids, values):
+        """
+        Total cost of holding each Definition at each value (vectorized over both).
+        """
+        values = np.asarray(values, dtype=np.int64).clip(min=0)
+        if not values.size:
+            return np.zeros(0, dtype=np.int64)
+        self.ensure(values.max())
+        return self.cumulative[self.lookup(def_ids), values]
+
+
+class CostEngine(object):
+    """
+    Per-StorySystem cache of CostTables, one per template, rebuilt whenever the
+    system's definition index is reloaded.
+    """
+
+    def __init__(self, system):
+        self.system = system
+        self.tables = dict()
+        self.generation = None
+
+    def table(self, template):
+        index = self.system.definitions
+        index._check()
+        if self.generation != index.generation:
+            self.tables = dict()
+            self.generation = index.generation
+        if (found := self.tables.get(template, None)) is None:
+            overrides = dict()
+            for name, rule in getattr(template, 'cost_rules', dict()).items():
+                if not (entry := index.by_identifier(name) or index.find_path(name)):
+                    raise ValueError(f"Template {template.__name__} has a cost rule for unknown trait: {name}")
+                overrides[entry.id] = rule
+            found = CostTable(index, overrides)
+            self.tables[template] = found
+        return found
+
+    def batch_cost(self, template, changes):
+        """
+        Cost of a batch of (definition id, old value, new value) changes. Lowered Traits
+        count as refunds (negative costs).
+
+        Returns:
+            total (int), costs (ndarray): The batch total and the cost of each change.
+        """
+        if not (changes := list(changes)):
+            return 0, np.zeros(0, dtype=np.int64)
+        def_ids, old, new = zip(*changes)
+        table = self.table(template)
+        costs = table.total(def_ids, new) - table.total(def_ids, old)
+        return int(costs.sum()), costs
+
+    def sheet_cost(self, persona):
+        """
+        What everything on a Persona's sheet would cost to buy from nothing.
+        """
+        sheet = persona.sheet
+        sheet._check()
+        if not sheet.keys:
+            return 0
+        def_ids = [def_id for def_id, icontext in sheet.keys]
+        return int(self.table(persona.__class__).total(def_ids, np.frombuffer(sheet.base, dtype=np.int64)).sum())
+
+    def audit(self):
+        """
+        Sheet cost of every Persona in the system, read straight from the database.
+
+        Returns:
+            costs (dict): {persona id: total cost}
+        """
+        from athanor_storyteller.buffers import WRITE_BEHIND
+        from athanor_storyteller.models import TraitDB
+        from athanor_storyteller.registry import TYPECLASSES
+        WRITE_BEHIND.flush()
+        rows = TraitDB.objects.filter(db_persona__db_system=self.system).values_list(
+            'db_persona_id', 'db_persona__db_typeclass_path', 'db_trait_definition_id', 'db_base_value')
+        templates = dict()
+        for persona_id, path, def_id, value in rows.iterator(chunk_size=2000):
+            found = templates.setdefault(path, ([], [], []))
+            found[0].append(persona_id)
+            found[1].append(def_id)
+            found[2].append(value)
+        totals = dict()
+        for path, (persona_ids, def_ids, values) in templates.items():
+            costs = self.table(TYPECLASSES.load_class(path)).total(def_ids, values)
+            personas, positions = np.unique(np.asarray(persona_ids, dtype=np.int64), return_inverse=True)
+            for persona_id, total in zip(personas.tolist(), np.bincount(positions, weights=costs).tolist()):
+                totals[persona_id] = int(total)
+        return totals
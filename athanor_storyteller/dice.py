@@ -0,0 +1,190 @@
+"""
+Storyteller d10 dice pools.
+
+Pools are rolled as 2D NumPy arrays (one row per pool, padded to the largest pool)
+so a whole scene's worth of rolls costs a handful of array operations. Exact success
+distributions for the "odds" family of commands are built by convolution once per
+rule-set and cached.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+FACES = 10
+
+# Explosion chains longer than this are vanishingly rare (0.1 ** 50) and are cut off.
+MAX_EXPLOSIONS = 50
+
+
+class RollResult(object):
+    __slots__ = ('pool', 'dice', 'successes', 'botch')
+
+    def __init__(self, pool, dice, successes, botch):
+        self.pool = pool
+        self.dice = dice
+        self.successes = successes
+        self.botch = botch
+
+    def __int__(self):
+        return self.successes
+
+    def __str__(self):
+        if self.botch:
+            return f"BOTCH! ({', '.join(str(d) for d in self.dice)})"
+        return f"{self.successes} successes ({', '.join(str(d) for d in self.dice)})"
+
+
+class DiceRoller(object):
+    """
+    A set of Storyteller roll rules.
+
+    Args:
+        target (int): Lowest face that counts as a success.
+        double (int or None): Faces at or above this count as two successes (Exalted 10s).
+        botch (bool): Whether a roll with no successes and at least one 1 is a botch.
+        reroll (iterable): Faces rerolled once, keeping the new result (e.g. (1,) for 'reroll 1s').
+        explode (iterable): Faces that add a bonus die (e.g. (10,) for '10-again').
+        rng (numpy.random.Generator): Source of randomness. A fresh default_rng if not given.
+    """
+
+    def __init__(self, target=7, double=10, botch=True, reroll=(), explode=(), rng=None):
+        self.target = target
+        self.double = double
+        self.botch = botch
+        self.reroll = tuple(sorted(set(reroll)))
+        self.explode = tuple(sorted(set(explode)))
+        self.rng = rng or np.random.default_rng()
+
+    def _count(self, dice):
+        successes = (dice >= self.target).sum(axis=1)
+        if self.double:
+            successes += (dice >= self.double).sum(axis=1)
+        return successes
+
+    def roll_many(self, pools):
+        """
+        Roll many pools at once.
+
+        Args:
+            pools (iterable of int): Number of dice in each pool.
+
+        Returns:
+            successes, botches, dice (ndarray): Per-pool success counts, per-pool botch
+                flags, and the (pools x largest pool) matrix of original faces with 0 as padding.
+        """
+        pools = np.asarray(pools, dtype=np.int64).clip(min=0)
+        width = int(pools.max()) if pools.size else 0
+        active = np.arange(width) < pools[:, None]
+        dice = self.rng.integers(1, FACES + 1, size=(pools.size, width))
+        if self.reroll:
+            mask = active & np.isin(dice, self.reroll)
+            dice[mask] = self.rng.integers(1, FACES + 1, size=int(mask.sum()))
+        dice[~active] = 0
+        successes = self._count(dice)
+        ones = (dice == 1).sum(axis=1)
+
+        if self.explode:
+            bonus = np.isin(dice, self.explode).sum(axis=1)
+            for _ in range(MAX_EXPLOSIONS):
+                if not (width := int(bonus.max()) if bonus.size else 0):
+                    break
+                extra = self.rng.integers(1, FACES + 1, size=(pools.size, width))
+                extra[np.arange(width) >= bonus[:, None]] = 0
+                successes += self._count(extra)
+                bonus = np.isin(extra, self.explode).sum(axis=1)
+
+        botches = (successes == 0) & (ones > 0) if self.botch else np.zeros(pools.size, dtype=bool)
+        return successes, botches, dice
+
+    def roll(self, pool):
+        successes, botches, dice = self.roll_many([pool])
+        return RollResult(pool, [int(d) for d in dice[0] if d], int(successes[0]), bool(botches[0]))
+
+    def table(self, max_pool=30):
+        return probability_table(self.target, self.double, self.reroll, self.explode, max_pool)
+
+    def odds(self, pool, successes=1):
+        """
+        Exact chance that pool dice score at least this many successes. Pools below
+        zero (after penalties) roll no dice, as in roll_many.
+        """
+        pool = max(int(pool), 0)
+        at_least, botch = probability_table(self.target, self.double, self.reroll, self.explode, max(pool, 30))
+        if successes <= 0:
+            return 1.0
+        if successes >= at_least.shape[1]:
+            return 0.0
+        return float(at_least[pool, successes])
+
+    def botch_odds(self, pool):
+        pool = max(int(pool), 0)
+        at_least, botch = probability_table(self.target, self.double, self.reroll, self.explode, max(pool, 30))
+        return float(botch[pool]) if self.botch else 0.0
+
+
+def _face_successes(face, target, double):
+    return int(face >= target) + int(bool(double) and face >= double)
+
+
+@lru_cache(maxsize=64)
+def probability_table(target, double, reroll, explode, max_pool=30):
+    """
+    Build the exact success distribution for every pool size up to max_pool.
+
+    Returns:
+        at_least (ndarray): at_least[n, k] is the chance that n dice score k or more successes.
+        botch (ndarray): botch[n] is the chance that n dice botch.
+
+    Both arrays are cached per rule-set and marked read-only.
+    """
+    faces = np.arange(1, FACES + 1)
+    face_odds = np.full(FACES, 1.0 / FACES)
+    if reroll:
+        rerolled = np.isin(faces, reroll)
+        face_odds = np.where(rerolled, 0.0, face_odds) + rerolled.sum() / FACES / FACES
+    scores = np.array([_face_successes(face, target, double) for face in faces])
+    exploding = np.isin(faces, explode)
+    # One die scores at most two per face rolled; a pool needs room for all of its dice.
+    die_width = 2 * (MAX_EXPLOSIONS + 1)
+    width = die_width + 2 * max_pool
+
+    def shifted(pmf, by):
+        out = np.zeros(die_width)
+        out[by:] = pmf[:die_width - by]
+        return out
+
+    # A bonus die from an explosion is fresh (never rerolled) and may itself explode.
+    chain = np.zeros(die_width)
+    chain[0] = 1.0
+    if explode:
+        for _ in range(MAX_EXPLOSIONS):
+            nxt = np.zeros(die_width)
+            for score, boom in zip(scores, exploding):
+                nxt += shifted(chain if boom else _unit(die_width), score) / FACES
+            chain = nxt
+
+    die = np.zeros(die_width)
+    for odds, score, boom in zip(face_odds, scores, exploding):
+        die += odds * shifted(chain if boom else _unit(die_width), score)
+
+    pmf = np.zeros((max_pool + 1, width))
+    pmf[0, 0] = 1.0
+    for n in range(1, max_pool + 1):
+        pmf[n] = np.convolve(pmf[n - 1], die)[:width]
+    at_least = np.flip(np.cumsum(np.flip(pmf, axis=1), axis=1), axis=1)
+
+    # A botch is no successes with at least one 1 showing among the original dice.
+    zero = die[0]
+    one_and_zero = face_odds[0] if scores[0] == 0 and not exploding[0] else 0.0
+    pools = np.arange(max_pool + 1)
+    botch = zero ** pools - (zero - one_and_zero) ** pools
+
+    at_least.flags.writeable = False
+    botch.flags.writeable = False
+    return at_least, botch
+
+
+def _unit(width):
+    out = np.zeros(width)
+    out[0] = 1.0
+    return out
@@ -1,13 +1,162 @@
 import re
+from contextlib import contextmanager
+from datetime import timedelta
+from django.db import transaction
+from evennia.typeclasses.attributes import Attribute
 from evennia.typeclasses.models import TypeclassBase
 from athanor.gamedb.base import HasAttributeGetCreate, lazy_property
-from athanor_storyteller.models import PersonaDB, TraitDefinitionDB, TraitDB, PoolDefinitionDB, PoolDB
+from athanor.utils.time import utcnow
+from athanor_storyteller.models import PersonaDB, TraitDefinitionDB, TraitDB, PoolDefinitionDB, PoolDB, TraitJournalDB
+from athanor_storyteller.handlers import SheetHandler, BonusHandler, SheetRenderer
+from athanor_storyteller.buffers import WRITE_BEHIND
+from athanor_storyteller.journal import JOURNAL
+from athanor_storyteller.instrumentation import instrumented
 
 
 class DefaultPersona(HasAttributeGetCreate, PersonaDB, metaclass=TypeclassBase):
+    # A Persona's typeclass is its template. template_traits maps a TraitDefinition system
+    # identifier or fullpath (optionally followed by ': context') to the value a Persona
+    # of this template starts with; template_pools lists PoolDefinition system identifiers.
+    template_traits = dict()
+    template_pools = tuple()
+    # Experience cost rules that replace the Definitions' own for this template, keyed
+    # like template_traits. See athanor_storyteller.costs.
+    cost_rules = dict()
+
+    @lazy_property
+    def sheet(self):
+        return SheetHandler(self)
+
+    @lazy_property
+    def bonuses(self):
+        return BonusHandler(self)
+
+    @lazy_property
+    def renderer(self):
+        return SheetRenderer(self)
+
+    @classmethod
+    def validate_name(cls, name):
+        if name is None or not (name := ' '.join(str(name).split())):
+            raise ValueError("Personas must have a name!")
+        if '/' in name:
+            raise ValueError("Persona names cannot contain a /")
+        return name
+
+    @classmethod
+    def create(cls, character, system, name):
+        name = cls.validate_name(name)
+        if PersonaDB.objects.filter(db_object=character, db_system=system, db_ikey=name.lower()).exists():
+            raise ValueError(f"{character} already has a Persona named {name}!")
+        # Fail on a broken template before anything is saved.
+        cls.resolve_template(system)
+        persona = cls(db_key=name, db_ikey=name.lower(), db_object=character, db_system=system)
+        try:
+            with persona.atomic():
+                persona.save()
+                persona.setup_template()
+        except Exception:
+            persona.flush_from_cache(force=True)
+            raise
+        return persona
+
+    @contextmanager
+    def atomic(self):
+        """
+        transaction.atomic() for changes to this Persona. Sheet, bonus, journal and hook
+        side effects are left to transaction.on_commit; if the outermost block fails,
+        the typeclass is put back, every Trait touched in memory is dropped from the
+        cache and the sheet and bonuses are reloaded from the database on next use.
+        """
+        if getattr(self, '_touched', None) is not None:
+            with transaction.atomic():
+                yield
+            return
+        old_class, old_path = self.__class__, self.db_typeclass_path
+        self._touched = list()
+        try:
+            with transaction.atomic():
+                yield
+        except Exception:
+            self.__class__, self.db_typeclass_path = old_class, old_path
+            for trait in self._touched:
+                trait.flush_from_cache(force=True)
+            self.sheet.release()
+            self.bonuses.release()
+            self.renderer.clear()
+            raise
+        finally:
+            self._touched = None
+
+    def rename(self, new_name):
+        new_name = self.validate_name(new_name)
+        if new_name.lower() != self.db_ikey and PersonaDB.objects.filter(
+                db_object_id=self.db_object_id, db_system_id=self.db_system_id, db_ikey=new_name.lower()).exists():
+            raise ValueError(f"{self.db_object} already has a Persona named {new_name}!")
+        self.db_key = new_name
+        self.db_ikey = new_name.lower()
+        self.save(update_fields=['db_key', 'db_ikey'])
+        return new_name
+
+    @classmethod
+    def resolve_template(cls, system):
+        """
+        Returns {(definition id, icontext): (DefinitionEntry, context, value)} for template_traits.
+        """
+        index = system.definitions
+        found = dict()
+        for name, value in cls.template_traits.items():
+            path, context = [part.strip() for part in name.split(':', 1)] if ':' in name else (name, '')
+            if not (entry := index.by_identifier(path) or index.find_path(path)):
+                raise ValueError(f"Template {cls.__name__} names unknown trait: {name}")
+            found[(entry.id, context.lower())] = (entry, context, value)
+        return found
 
     def setup_template(self):
-        pass
+        self.apply_template(None)
+
+    def apply_template(self, old_template):
+        """
+        Moves this Persona from old_template's traits and pools (None for a fresh Persona)
+        to those of its current typeclass. Only the difference is written: traits the new
+        template adds are created (or raised to their starting value), traits only the old
+        one had are removed, and pools follow the same rule. Everything is applied in one
+        transaction (see atomic()); traits both templates share are not touched.
+        """
+        system = self.db_system
+        index = system.definitions
+        new_traits = self.resolve_template(system)
+        old_traits = old_template.resolve_template(system) if old_template else dict()
+        entries = list()
+        for key, (entry, context, value) in new_traits.items():
+            if key not in old_traits and (self.sheet.get_slot(entry.id, context) is None or
+                                          self.sheet.get_base(entry.id, context) < value):
+                entries.append((index.get_definition(entry), context, value))
+        for key, (entry, context, value) in old_traits.items():
+            if key not in new_traits and self.sheet.get_slot(entry.id, context) is not None:
+                entries.append((index.get_definition(entry), context, -1))
+
+        new_pools = set(self.template_pools)
+        old_pools = set(old_template.template_pools) if old_template else set()
+        added, removed = new_pools - old_pools, old_pools - new_pools
+        with self.atomic():
+            if entries:
+                self.set_trait_values(entries, validate=False)
+            if removed and (doomed := list(self.pools.filter(db_pool_definition__db_system_identifier__in=removed))):
+                pool_ids = [pool.id for pool in doomed]
+                Attribute.objects.filter(pooldb__id__in=pool_ids).delete()
+                PoolDB.objects.filter(id__in=pool_ids).delete()
+                transaction.on_commit(lambda: self._forget_pools(doomed))
+            if added:
+                existing = set(self.pools.values_list('db_pool_definition_id', flat=True))
+                creates = [DefaultPool.create(self, pool_def) for pool_def in
+                           system.pool_definitions.filter(db_system_identifier__in=added) if pool_def.id not in existing]
+                PoolDB.objects.bulk_create(creates)
+
+    def _forget_pools(self, pools):
+        for pool in pools:
+            WRITE_BEHIND.discard(pool)
+            pool.flush_from_cache(force=True)
 
     def pre_change_template(self, new_template):
         pass
@@ -15,30 +164,182 @@ class DefaultPersona(HasAttributeGetCreate, PersonaDB, metaclass=TypeclassBase):
     def change_template(self, new_template):
         self.pre_change_template(new_template)
         old_class = self.__class__
-        self.swap_typeclass(new_template, run_start_hooks='None')
-        self.setup_template()
+        with self.atomic():
+            # Registered first so the entry precedes the trait changes it causes, and only if they commit.
+            transaction.on_commit(lambda: JOURNAL.record(self, None, f"{old_class.path} -> {new_template.path}",
+                                                         None, None, TraitJournalDB.KIND_TEMPLATE))
+            self.swap_typeclass(new_template, run_start_hooks='None')
+            self.apply_template(old_class)
+        self.renderer.clear()
 
-    def set_trait_value(self, trait, context, value):
+    def validate_trait_value(self, trait, context, value, existing=None):
         if not trait.db_allow_buy:
-            raise ValueError(f"{trait} is not a trait that can be ")
-        if value == 0 and not trait.db_allow_zero:
+            raise ValueError(f"{trait} is not a trait that can be bought!")
+        if context and not trait.db_allow_context:
+            raise ValueError(f"{trait} does not allow Contexts!")
+        if trait.db_require_context and not context:
+            raise ValueError(f"{trait} requires a Context!")
+        if value == 0 and not trait.db_allow_zero and not existing:
             raise ValueError(f"{trait} does not allow buying at Zero!")
-        if not context:
-            context = ''
-        found_trait = None
-        if not (found_trait := self.traits.filter(db_trait_definition=trait, db_icontext=context.lower())):
-            found_trait = trait.trait_typeclass.create(persona=self, trait_def=trait, context=context, value=value)
-        else:
-            if context:
-                found_trait.db_context = context
-            found_trait.set_value(value)
+
+    def set_trait_value(self, trait, context, value):
+        return self.set_trait_values([(trait, context, value)])[0]
+
+    def set_trait_values(self, entries, validate=True):
+        """
+        Sets many Traits at once.
+
+        Args:
+            entries (iterable): (TraitDefinition, context, value) tuples. If the same
+                Definition and context appear more than once, the last one wins.
+
+        Returns:
+            traits (list): The Trait now holding each entry's value, or None where
+                the entry removed the Trait.
+
+        Every entry is validated (unless validate is False, as for template setup)
+        before anything is written. Creations, updates and
+        deletions are then applied as bulk operations inside one transaction, and
+        at_set_value runs once per surviving Trait after it commits.
+        """
+        entries = [(trait, context or '', value) for trait, context, value in entries]
+        keys = [(trait.id, context.lower()) for trait, context, value in entries]
+        wanted = dict(zip(keys, entries))
+        existing = {(t.db_trait_definition_id, t.db_icontext): t
+                    for t in self.traits.filter(db_trait_definition_id__in={key[0] for key in wanted})}
+
+        errors = list()
+        for key, (trait, context, value) in (wanted.items() if validate else ()):
+            try:
+                self.validate_trait_value(trait, context, value, existing.get(key, None))
+            except ValueError as err:
+                errors.append(str(err))
+        if errors:
+            raise ValueError('\n'.join(errors))
+
+        results = dict()
+        creates, updates, deletes, changed = list(), list(), list(), list()
+        for key, (trait, context, value) in wanted.items():
+            found = existing.get(key, None)
+            keep = value > -1 if trait.db_allow_zero else value > 0
+            if not keep:
+                if found:
+                    deletes.append(found)
+                results[key] = None
+            elif found:
+                changed.append((found, int(found)))
+                found.db_base_value = value
+                if context:
+                    found.db_context = context
+                updates.append(found)
+                results[key] = found
+            else:
+                new_trait = trait.trait_typeclass.create(persona=self, trait_def=trait, context=context, value=value)
+                creates.append(new_trait)
+                changed.append((new_trait, 0))
+                results[key] = new_trait
+
+        # Updated Traits may also have pending damage or marks; write those along with them.
+        update_fields = {'db_base_value', 'db_context'}
+        for found in updates:
+            update_fields |= WRITE_BEHIND.fields(found)
+        with self.atomic():
+            self._touched.extend(updates)
+            if deletes:
+                delete_ids = [found.id for found in deletes]
+                Attribute.objects.filter(traitdb__id__in=delete_ids).delete()
+                TraitDB.objects.filter(id__in=delete_ids).delete()
+            if updates:
+                TraitDB.objects.bulk_update(updates, sorted(update_fields))
+            if creates:
+                TraitDB.objects.bulk_create(creates)
+                if any(new_trait.pk is None for new_trait in creates):
+                    # Backends that don't return primary keys from bulk_create need a re-read.
+                    fresh = {(t.db_trait_definition_id, t.db_icontext): t for t in
+                             self.traits.filter(db_trait_definition_id__in={t.db_trait_definition_id for t in creates})}
+                    for key, new_trait in list(results.items()):
+                        if new_trait is not None and new_trait.pk is None:
+                            results[key] = fresh[key]
+                    changed = [(results[(t.db_trait_definition_id, t.db_icontext)], old) for t, old in changed]
+                else:
+                    for new_trait in creates:
+                        new_trait.cache_instance(new_trait, new=True)
+            self._touched.extend(found for found, old_value in changed)
+            transaction.on_commit(lambda: self._after_set_values(deletes, changed))
+        return [results[key] for key in keys]
+
+    def _after_set_values(self, deletes, changed):
+        for found in deletes:
+            WRITE_BEHIND.discard(found)
+            self.sheet.remove(found)
+            JOURNAL.record(self, found.db_trait_definition_id, found.db_context, int(found), None)
+            found.at_delete()
+            found.flush_from_cache(force=True)
+        for found, old_value in changed:
+            self.sheet.update(found)
+            JOURNAL.record(self, found.db_trait_definition_id, found.db_context, old_value, int(found))
+        for found, old_value in changed:
+            found.at_set_value(old_value)
+
+    def experience_cost(self, entries):
+        """
+        Cost of setting several Traits, as (TraitDefinition, context, value) tuples.
+
+        Returns:
+            total (int), costs (ndarray): See CostEngine.batch_cost.
+        """
+        changes = [(trait.id, self.sheet.get_base(trait, context or ''), value) for trait, context, value in entries]
+        return self.db_system.costs.batch_cost(self.__class__, changes)
+
+    def sheet_cost(self):
+        return self.db_system.costs.sheet_cost(self)
+
+    def recalculate_pools(self, identifier=None):
+        """
+        Refresh the maximum of every Pool computed from identifier (or all Pools).
+        """
+        for pool in self.pools.all():
+            if identifier is None or identifier in pool.db_pool_definition.maximum_traits:
+                pool.recalculate_maximum()
+
+    def marked_traits(self, mark):
+        return TraitDB.filter_marked(mark, self.traits.all())
+
+    def calculate(self, trait, context='', bonus=False):
+        """
+        Reads a Trait's value straight from the sheet arrays without loading any Trait.
+        trait may be a TraitDefinition, its id, or its system identifier.
+        """
+        return self.sheet.calculate(trait, context, bonus)
+
+    def dice_pool(self, *traits, bonus=True):
+        """
+        Sums the values of several traits. Each entry is anything calculate() accepts,
+        or a (trait, context) tuple.
+        """
+        total = 0
+        for trait in traits:
+            if isinstance(trait, tuple):
+                total += self.sheet.calculate(trait[0], trait[1], bonus)
+            else:
+                total += self.sheet.calculate(trait, '', bonus)
+        return total
+
+    def roll(self, *traits, modifier=0, roller=None, **kwargs):
+        """
+        Rolls the dice pool formed by traits. Extra kwargs configure a DiceRoller.
+        """
+        from athanor_storyteller.dice import DiceRoller
+        if not roller:
+            roller = DiceRoller(**kwargs)
+        return roller.roll(self.dice_pool(*traits) + modifier)
 
     def get_bonus(self, identifier):
         """
         Given a TraitDefinition identifier, return any bonuses this Persona is getting
         to that trait.
         """
-        return 0
+        return self.bonuses.get(identifier)
 
 
 class DefaultTraitDefinition(HasAttributeGetCreate, TraitDefinitionDB, metaclass=TypeclassBase):
@@ -47,34 +348,49 @@ class DefaultTraitDefinition(HasAttributeGetCreate, TraitDefinitionDB, metaclass
     re_normalize_2 = re.compile(r"(?i)\b(of|the|a|and|in)\b")
     re_normalize_3 = re.compile(r"(?i)(^|(?<=[(\|\/]))(of|the|a|and|in)")
 
+    # Marks a Trait of this Definition may carry. Each mark's position is its bit in
+    # TraitDB.db_marks, so only ever append to this list. At most 62 entries.
     can_mark = []
 
+    @classmethod
+    def mark_bit(cls, mark):
+        try:
+            position = cls.can_mark.index(mark)
+        except ValueError:
+            raise ValueError(f"{cls.__name__} cannot be marked {mark}!")
+        if position > 61:
+            raise ValueError(f"{cls.__name__} has too many marks!")
+        return 1 << position
+
     @classmethod
     def normalize_name(cls, name):
         name = cls.re_normalize_0.sub(' ', name.strip())
-        name = cls.re_normalize_1.sub(name.strip(), lambda find: find.group('name1').capitalize())
+        name = cls.re_normalize_1.sub(lambda find: find.group('name1').capitalize(), name.strip())
         name = cls.re_normalize_2.sub(lambda find: find.group(1).lower(), name)
         name = cls.re_normalize_3.sub(lambda find: find.group(1) + find.group(2).capitalize(), name)
         return name
 
 class DefaultTrait(HasAttributeGetCreate, TraitDB, metaclass=TypeclassBase):
 
-    @lazy_property
+    @property
     def marked(self):
-        return self.get_or_create_attribute(key='marked', default=set())
+        can_mark = self.db_trait_definition.can_mark
+        return {mark for position, mark in enumerate(can_mark) if self.db_marks & (1 << position)}
 
     def is_marked(self, mark):
-        return mark in self.marked
+        return bool(self.db_marks & self.db_trait_definition.mark_bit(mark))
 
     def set_marked(self, mark):
         if self.is_marked(mark):
             raise ValueError(f"{self} is already marked {mark}!")
-        self.marked.add(mark)
+        self.db_marks |= self.db_trait_definition.mark_bit(mark)
+        WRITE_BEHIND.save(self, 'db_marks')
 
     def unset_marked(self, mark):
         if not self.is_marked(mark):
-            raise ValueError(f"{self} is already marked {mark}!")
-        self.marked.remove(mark)
+            raise ValueError(f"{self} is not marked {mark}!")
+        self.db_marks &= ~self.db_trait_definition.mark_bit(mark)
+        WRITE_BEHIND.save(self, 'db_marks')
 
     @classmethod
     def create(cls, persona, trait_def, context, value):
@@ -88,28 +404,64 @@ class DefaultTrait(HasAttributeGetCreate, TraitDB, metaclass=TypeclassBase):
     def __int__(self):
         return int(self.db_base_value)
 
+    @instrumented('trait.set_value')
     def _set_value(self, value):
         """
         Implements the meat of setting a value. Cuts down on super() usage.
         """
-        old_value = int(self.db_value)
+        old_value = int(self)
         self.db_base_value = value
+        WRITE_BEHIND.save(self, 'db_base_value')
+        self.db_persona.sheet.update(self)
+        JOURNAL.record(self.db_persona, self.db_trait_definition_id, self.db_context, old_value, value)
         self.at_set_value(old_value)
         return value
 
+    @instrumented('trait.at_set_value')
     def at_set_value(self, old_value):
         """
         General abstract hook used for things like re-calculating other values.
+        Overloads should call super() to keep bonuses and Pool maximums current.
         """
-        pass
+        persona = self.db_persona
+        persona.bonuses.update_trait(self)
+        entry = persona.db_system.definitions.get(self.db_trait_definition_id)
+        if entry and entry.system_identifier in persona.db_system.pool_identifiers:
+            persona.recalculate_pools(entry.system_identifier)
 
+    @instrumented('trait.at_delete')
     def at_delete(self):
-        pass
+        """
+        Runs once the Trait is off the sheet. Overloads should call super() to keep
+        bonuses and Pool maximums current.
+        """
+        persona = self.db_persona
+        persona.bonuses.remove_trait(self)
+        entry = persona.db_system.definitions.get(self.db_trait_definition_id)
+        if entry and entry.system_identifier in persona.db_system.pool_identifiers:
+            persona.recalculate_pools(entry.system_identifier)
 
+    @instrumented('trait.delete_value')
     def delete_value(self, value):
+        self.db_persona.sheet.remove(self)
         self.at_delete()
+        JOURNAL.record(self.db_persona, self.db_trait_definition_id, self.db_context, int(self), None)
+        WRITE_BEHIND.discard(self)
         self.delete()
 
+    @instrumented('trait.set_damage')
+    def set_damage(self, value):
+        """
+        Records damage (or spent dots) against this Trait without touching its base value.
+        """
+        old_value = self.db_damage_value
+        self.db_damage_value = max(0, value)
+        WRITE_BEHIND.save(self, 'db_damage_value')
+        JOURNAL.record(self.db_persona, self.db_trait_definition_id, self.db_context, old_value,
+                       self.db_damage_value, TraitJournalDB.KIND_DAMAGE)
+        self.db_persona.sheet.update(self)
+        return self.db_damage_value
+
     def set_value(self, value):
         """
         Called by the controller to set this Trait's Value.
@@ -129,14 +481,73 @@ class DefaultTrait(HasAttributeGetCreate, TraitDB, metaclass=TypeclassBase):
         """
         Returns this trait's value for dice rolls and other purposes.
         """
-        if bonus and (identifier := self.db_trait_definition.db_system_identifier):
-            return int(self) + self.db_persona.get_bonus(identifier)
-        return int(self)
+        return self.db_persona.sheet.calculate(self.db_trait_definition_id, self.db_icontext, bonus)
 
 
 class DefaultPoolDefinition(HasAttributeGetCreate, PoolDefinitionDB, metaclass=TypeclassBase):
-    pass
+
+    @property
+    def maximum_traits(self):
+        return [identifier.strip() for identifier in self.db_maximum_traits.split(',') if identifier.strip()]
+
+    def calculate_maximum(self, persona):
+        """
+        The trait-derived part of a Pool's maximum for persona. Overload for odder formulas.
+        """
+        total = sum(persona.calculate(identifier) for identifier in self.maximum_traits)
+        return self.db_maximum_base + self.db_maximum_multiplier * total
+
+    @property
+    def regenerates(self):
+        return self.db_regen_amount > 0 and self.db_regen_interval > 0
 
 
 class DefaultPool(HasAttributeGetCreate, PoolDB, metaclass=TypeclassBase):
-    pass
+
+    @classmethod
+    def create(cls, persona, pool_def):
+        maximum = pool_def.calculate_maximum(persona)
+        return cls(db_persona=persona, db_pool_definition=pool_def, db_maximum=maximum, db_current_value=maximum)
+
+    def __str__(self):
+        return str(self.db_pool_definition.db_key)
+
+    def __int__(self):
+        return int(self.db_current_value)
+
+    def _schedule_regen(self):
+        pool_def = self.db_pool_definition
+        if self.db_current_value >= self.db_maximum or not pool_def.regenerates:
+            self.db_next_regen = None
+        elif not self.db_next_regen:
+            self.db_next_regen = utcnow() + timedelta(seconds=pool_def.db_regen_interval)
+
+    def recalculate_maximum(self):
+        maximum = self.db_pool_definition.calculate_maximum(self.db_persona) + self.db_bonus_maximum
+        if maximum == self.db_maximum:
+            return maximum
+        self.db_maximum = maximum
+        self.db_current_value = min(self.db_current_value, maximum)
+        self._schedule_regen()
+        WRITE_BEHIND.save(self, 'db_maximum', 'db_current_value', 'db_next_regen')
+        return maximum
+
+    def set_bonus_maximum(self, value):
+        self.db_bonus_maximum = value
+        WRITE_BEHIND.save(self, 'db_bonus_maximum')
+        self.recalculate_maximum()
+        return value
+
+    def set_current(self, value):
+        self.db_current_value = max(0, min(value, self.db_maximum))
+        self._schedule_regen()
+        WRITE_BEHIND.save(self, 'db_current_value', 'db_next_regen')
+        return self.db_current_value
+
+    def spend(self, amount):
+        if amount > self.db_current_value:
+            raise ValueError(f"Not enough {self}! Have {self.db_current_value}, need {amount}.")
+        return self.set_current(self.db_current_value - amount)
+
+    def gain(self, amount):
+        return self.set_current(self.db_current_value + amount)
@@ -1,4 +1,395 @@
+from array import array
+from evennia.utils.ansi import ANSIString
+from athanor_storyteller.buffers import WRITE_BEHIND
+from athanor_storyteller.cache import CACHE
+
+
 class PersonaHandler(object):
+    """
+    Holds a Character's Personas, with their Traits and Pools, while it is puppeted.
+
+    load() pulls everything in a fixed number of queries (Personas with their
+    StorySystems, Traits, TraitDefinitions, Pools and PoolDefinitions) and builds the
+    sheet of every Persona from the prefetched Traits. release() drops all of it again
+    and evicts the Traits and Pools from the idmapper.
+    """
+    attribute_key = 'storyteller_persona'
 
     def __init__(self, owner):
         self.owner = owner
+        self.loaded = False
+        self.personas = list()
+        self.active = None
+
+    def load(self):
+        from athanor_storyteller.models import PersonaDB
+        if self.loaded:
+            return
+        WRITE_BEHIND.flush()
+        self.personas = list(PersonaDB.objects.filter(db_object=self.owner).select_related('db_system').prefetch_related(
+            'traits__db_trait_definition', 'pools__db_pool_definition').order_by('id'))
+        for persona in self.personas:
+            persona.sheet.load(traits=persona.traits.all())
+        active_id = self.owner.attributes.get(key=self.attribute_key, default=None)
+        self.active = next((p for p in self.personas if p.id == active_id), self.personas[0] if self.personas else None)
+        self.loaded = True
+
+    def release(self):
+        # Pending writes must land before their instances leave the idmapper.
+        WRITE_BEHIND.flush()
+        for persona in self.personas:
+            prefetched = getattr(persona, '_prefetched_objects_cache', dict())
+            for related in ('traits', 'pools'):
+                for found in prefetched.get(related, list()):
+                    found.flush_from_cache(force=True)
+            prefetched.clear()
+            persona.sheet.release()
+            persona.bonuses.release()
+            persona.renderer.clear()
+        self.personas = list()
+        self.active = None
+        self.loaded = False
+
+    def _check(self):
+        if not self.loaded:
+            self.load()
+
+    def all(self):
+        self._check()
+        return list(self.personas)
+
+    def get(self, persona_id):
+        self._check()
+        return next((p for p in self.personas if p.id == persona_id), None)
+
+    def get_active(self):
+        self._check()
+        return self.active
+
+    def set_active(self, persona):
+        self._check()
+        if persona not in self.personas:
+            raise ValueError(f"{persona} does not belong to {self.owner}!")
+        self.active = persona
+        self.owner.attributes.add(key=self.attribute_key, value=persona.id)
+
+    @property
+    def sheet(self):
+        return active.sheet if (active := self.get_active()) else None
+
+
+class SheetHandler(object):
+    """
+    Compact, array-backed snapshot of a Persona's Trait values.
+
+    Each (definition id, icontext) pair owns a slot; base values, damage and bonuses
+    live in parallel typed arrays so reading a value never touches a Trait or
+    TraitDefinition instance. It is loaded from one values query and kept current by
+    DefaultTrait._set_value / delete_value rather than reloaded.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.loaded = False
+        self.slots = dict()
+        self.keys = list()
+        self.contexts = list()
+        self.identifiers = list()
+        self.by_identifier = dict()
+        self.base = array('q')
+        self.damage = array('q')
+        self.bonus = array('q')
+
+    def release(self):
+        self.loaded = False
+        self.slots = dict()
+        self.keys = list()
+        self.contexts = list()
+        self.identifiers = list()
+        self.by_identifier = dict()
+        self.base = array('q')
+        self.damage = array('q')
+        self.bonus = array('q')
+
+    def load(self, traits=None):
+        """
+        Fill the sheet with one values query, or from already-loaded Trait instances.
+        """
+        self.release()
+        CACHE.miss(self.owner)
+        if traits is None:
+            WRITE_BEHIND.flush()
+            traits = self.owner.traits.values_list('db_trait_definition_id', 'db_icontext', 'db_base_value',
+                                                   'db_damage_value', 'db_context')
+        else:
+            traits = ((t.db_trait_definition_id, t.db_icontext, t.db_base_value, t.db_damage_value, t.db_context)
+                      for t in traits)
+        for def_id, icontext, base, damage, context in traits:
+            self._add(def_id, icontext, base, damage, 0, context)
+        self.loaded = True
+        # Bonuses are derived from the sheet itself, so they can only be filled in once it exists.
+        for identifier in self.by_identifier:
+            self.set_bonus(identifier, self.owner.get_bonus(identifier))
+
+    def _check(self):
+        if self.loaded:
+            CACHE.hit(self.owner)
+        else:
+            self.load()
+
+    def _add(self, def_id, icontext, base, damage, bonus=None, context=''):
+        slot = len(self.keys)
+        entry = self.owner.db_system.definitions.get(def_id)
+        identifier = entry.system_identifier if entry else None
+        self.slots[(def_id, icontext)] = slot
+        self.keys.append((def_id, icontext))
+        self.contexts.append(context)
+        self.identifiers.append(identifier)
+        self.base.append(base)
+        self.damage.append(damage)
+        if bonus is None:
+            bonus = self.owner.get_bonus(identifier) if identifier else 0
+        self.bonus.append(bonus)
+        if identifier:
+            self.by_identifier.setdefault(identifier, list()).append(slot)
+        return slot
+
+    def update(self, trait):
+        """
+        Record a Trait's current values. Does nothing until the sheet has been loaded.
+        """
+        self.owner.renderer.invalidate(trait.db_trait_definition_id)
+        if not self.loaded:
+            return
+        key = (trait.db_trait_definition_id, trait.db_icontext)
+        if (slot := self.slots.get(key, None)) is None:
+            self._add(key[0], key[1], trait.db_base_value, trait.db_damage_value, context=trait.db_context)
+        else:
+            self.base[slot] = trait.db_base_value
+            self.damage[slot] = trait.db_damage_value
+            self.contexts[slot] = trait.db_context
+
+    def remove(self, trait):
+        self.owner.renderer.invalidate(trait.db_trait_definition_id)
+        if not self.loaded:
+            return
+        key = (trait.db_trait_definition_id, trait.db_icontext)
+        if (slot := self.slots.pop(key, None)) is None:
+            return
+        identifier = self.identifiers[slot]
+        if identifier:
+            self.by_identifier[identifier].remove(slot)
+            if not self.by_identifier[identifier]:
+                del self.by_identifier[identifier]
+        last = len(self.keys) - 1
+        if slot != last:
+            # Move the final slot into the hole so the arrays stay contiguous.
+            moved_key, moved_identifier = self.keys[last], self.identifiers[last]
+            self.keys[slot], self.identifiers[slot] = moved_key, moved_identifier
+            self.contexts[slot] = self.contexts[last]
+            self.base[slot], self.damage[slot], self.bonus[slot] = self.base[last], self.damage[last], self.bonus[last]
+            self.slots[moved_key] = slot
+            if moved_identifier:
+                moved = self.by_identifier[moved_identifier]
+                moved[moved.index(last)] = slot
+        del self.keys[last], self.contexts[last], self.identifiers[last]
+        del self.base[last], self.damage[last], self.bonus[last]
+
+    def set_bonus(self, identifier, total):
+        if not self.loaded:
+            return
+        for slot in self.by_identifier.get(identifier, ()):
+            self.bonus[slot] = total
+
+    def get_slot(self, trait, context=''):
+        """
+        Locate a slot by TraitDefinition (or its id) or system identifier, and context.
+        All three ways of naming the Trait find the same slot for the same context.
+        """
+        self._check()
+        if isinstance(trait, str):
+            if not (entry := self.owner.db_system.definitions.by_identifier(trait)):
+                return None
+            def_id = entry.id
+        else:
+            def_id = trait if isinstance(trait, int) else trait.id
+        return self.slots.get((def_id, context.lower()), None)
+
+    def get_base(self, trait, context=''):
+        return 0 if (slot := self.get_slot(trait, context)) is None else self.base[slot]
+
+    def get_damage(self, trait, context=''):
+        return 0 if (slot := self.get_slot(trait, context)) is None else self.damage[slot]
+
+    def calculate(self, trait, context='', bonus=False):
+        if (slot := self.get_slot(trait, context)) is None:
+            return 0
+        if bonus:
+            return self.base[slot] + self.bonus[slot]
+        return self.base[slot]
+
+    def entries(self):
+        """
+        Yields (definition id, icontext, base, damage) for every slot.
+        """
+        self._check()
+        for slot, (def_id, icontext) in enumerate(self.keys):
+            yield def_id, icontext, self.base[slot], self.damage[slot]
+
+    def display_entries(self):
+        """
+        Like entries(), but yields the Trait's display context instead of icontext.
+        """
+        self._check()
+        for slot, (def_id, icontext) in enumerate(self.keys):
+            yield def_id, self.contexts[slot], self.base[slot], self.damage[slot]
+
+
+class BonusHandler(object):
+    """
+    Keeps running bonus totals for a Persona, keyed by target system identifier.
+
+    Every source (a Trait, or anything else registered with set_source, such as
+    equipment) maps to the targets it boosts. When a source changes only the targets
+    it touches are adjusted, and the new totals are pushed into the SheetHandler, so
+    get() and the sheet's bonus column are both plain lookups.
+
+    Non-Trait sources are also kept in external, which survives release(), so they
+    are folded back in whenever the totals are rebuilt.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.loaded = False
+        self.sources = dict()
+        self.totals = dict()
+        self.external = dict()
+
+    def release(self):
+        self.loaded = False
+        self.sources = dict()
+        self.totals = dict()
+
+    def load(self):
+        self.release()
+        self.loaded = True
+        index = self.owner.db_system.definitions
+        for def_id, icontext, base, damage in self.owner.sheet.entries():
+            if (entry := index.get(def_id)) and entry.bonuses:
+                self._set_source(('trait', def_id, icontext), entry.get_bonuses(base), push=False)
+        for key, bonuses in self.external.items():
+            self._set_source(key, bonuses, push=False)
+        for identifier, total in self.totals.items():
+            self.owner.sheet.set_bonus(identifier, total)
+
+    def _check(self):
+        if not self.loaded:
+            self.load()
+
+    def get(self, identifier):
+        self._check()
+        return self.totals.get(identifier, 0)
+
+    def _set_source(self, key, bonuses, push=True):
+        old = self.sources.pop(key, dict())
+        if bonuses:
+            self.sources[key] = bonuses
+        for identifier in set(old) | set(bonuses):
+            if not (delta := bonuses.get(identifier, 0) - old.get(identifier, 0)):
+                continue
+            if (total := self.totals.get(identifier, 0) + delta):
+                self.totals[identifier] = total
+            else:
+                self.totals.pop(identifier, None)
+            if push:
+                self.owner.sheet.set_bonus(identifier, total)
+
+    def set_source(self, key, bonuses):
+        """
+        Register or replace a non-Trait source, like a worn item.
+
+        Args:
+            key (hashable): Unique name for the source.
+            bonuses (dict): {target identifier: amount}.
+        """
+        if bonuses:
+            self.external[key] = dict(bonuses)
+        else:
+            self.external.pop(key, None)
+        if self.loaded:
+            self._set_source(key, bonuses)
+
+    def remove_source(self, key):
+        self.external.pop(key, None)
+        if self.loaded:
+            self._set_source(key, dict())
+
+    def update_trait(self, trait):
+        if not self.loaded:
+            return
+        entry = self.owner.db_system.definitions.get(trait.db_trait_definition_id)
+        bonuses = entry.get_bonuses(trait.db_base_value) if entry else dict()
+        self._set_source(('trait', trait.db_trait_definition_id, trait.db_icontext), bonuses)
+
+    def remove_trait(self, trait):
+        if self.loaded:
+            self._set_source(('trait', trait.db_trait_definition_id, trait.db_icontext), dict())
+
+
+class SheetRenderer(object):
+    """
+    Renders a Persona's sheet as ANSIString sections, one per top-level TraitDefinition,
+    and keeps each rendered section until a Trait beneath that root changes.
+    """
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.sections = dict()
+
+    def clear(self):
+        self.sections = dict()
+
+    def invalidate(self, def_id):
+        if not self.sections:
+            return
+        if (root := self.owner.db_system.definitions.root_of(def_id)):
+            for key in [key for key in self.sections if key[0] == root.id]:
+                del self.sections[key]
+
+    def render_section(self, root, width=78):
+        index = self.owner.db_system.definitions
+        rows = list()
+        for def_id, context, base, damage in self.owner.sheet.display_entries():
+            if not (found := index.root_of(def_id)) or found.id != root.id:
+                continue
+            entry = index.get(def_id)
+            name = index.fullpath(entry)[len(index.fullpath(root)) + 1:] or entry.key
+            if context:
+                name = f"{name}: {context}"
+            value = f"{base}/{damage}" if damage else str(base)
+            rows.append((name.lower(), name, value))
+        lines = [ANSIString(f"|w{root.key}|n").center(width, '-')]
+        for sort_key, name, value in sorted(rows):
+            lines.append(ANSIString(f"  {name} ").ljust(width - 8, '.') + ANSIString(f" {value}").rjust(8))
+        return ANSIString('\n').join(lines)
+
+    def render(self, sections=None, width=78):
+        """
+        Args:
+            sections (list): DefinitionEntry roots to show. Every root with Traits if not given.
+            width (int): Line width.
+
+        Returns:
+            sheet (ANSIString)
+        """
+        index = self.owner.db_system.definitions
+        if sections is None:
+            roots = {index.root_of(def_id) for def_id, icontext, base, damage in self.owner.sheet.entries()}
+            sections = sorted((root for root in roots if root), key=lambda root: root.ikey)
+        output = list()
+        for root in sections:
+            if (found := self.sections.get((root.id, width), None)) is None:
+                found = self.render_section(root, width)
+                self.sections[(root.id, width)] = found
+            output.append(found)
+        return ANSIString('\n').join(output)
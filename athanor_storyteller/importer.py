@@ -0,0 +1,218 @@
+import json
+
+from django.db import transaction
+
+from athanor_storyteller.models import StorySystem, TraitDefinitionDB
+from athanor_storyteller.registry import TYPECLASSES
+
+
+class DefinitionImporter(object):
+    """
+    Loads a TraitDefinition tree into a StorySystem in bulk.
+
+    Accepts either nested tree documents (JSON or YAML, each node optionally carrying
+    'children') or flat streams (JSON Lines, or multi-document YAML) where each node
+    names its parent by system identifier or fullpath. Nodes are matched to existing
+    rows by their fullpath, then written one depth level at a time: new rows with
+    bulk_create, changed rows with bulk_update, and identical rows not at all, so
+    re-running the same file is a no-op.
+
+    read() streams JSON Lines and multi-document YAML, but run() keeps every node (a
+    small dict) until the whole tree is resolved, because a flat stream may name a
+    parent that comes later and rows are written shallowest level first. Memory is
+    therefore proportional to the size of the import, not the size of the file.
+    """
+    # Node key -> TraitDefinitionDB field.
+    fields = {
+        'identifier': 'db_system_identifier',
+        'default_value': 'db_default_value',
+        'allow_context': 'db_allow_context',
+        'require_context': 'db_require_context',
+        'can_specialize': 'db_can_specialize',
+        'can_roll': 'db_can_roll',
+        'allow_zero': 'db_allow_zero',
+        'allow_buy': 'db_allow_buy',
+        'approved': 'db_approved',
+        'trait_typeclass': 'db_trait_default_typeclass',
+        'child_typeclass': 'db_child_default_typeclass',
+        'bonuses': 'db_bonuses',
+        'cost_rule': 'db_cost_rule',
+        'typeclass': 'db_typeclass_path',
+    }
+
+    def __init__(self, system, batch_size=500):
+        self.system = system
+        self.batch_size = batch_size
+        self.names = dict()
+        self.stats = {'created': 0, 'updated': 0, 'unchanged': 0}
+
+    def normalize(self, name):
+        if (found := self.names.get(name, None)) is None:
+            found = TYPECLASSES.get_default_definition().normalize_name(name)
+            self.names[name] = found
+        return found
+
+    def read(self, stream, format='json'):
+        """
+        Yields flat node dicts from a file-like object.
+        """
+        if format == 'jsonl':
+            for line in stream:
+                if (line := line.strip()):
+                    yield json.loads(line)
+        elif format == 'json':
+            yield from self.flatten(json.load(stream))
+        elif format == 'yaml':
+            import yaml
+            for document in yaml.safe_load_all(stream):
+                yield from self.flatten(document)
+        else:
+            raise ValueError(f"Unknown definition format: {format}")
+
+    def flatten(self, document, parent=None):
+        if document is None:
+            return
+        if isinstance(document, dict) and 'definitions' in document:
+            document = document['definitions']
+        if isinstance(document, dict):
+            document = [document]
+        for node in document:
+            node = dict(node)
+            children = node.pop('children', None) or list()
+            key = self.normalize(node['key'])
+            path = f"{parent}/{key}" if parent else key
+            if parent:
+                node['parent'] = parent
+            yield node
+            yield from self.flatten(children, path)
+
+    def _prepare(self, node):
+        values = dict()
+        for name, field in self.fields.items():
+            if name not in node:
+                continue
+            value = node[name]
+            if name in ('bonuses', 'cost_rule') and isinstance(value, dict):
+                value = json.dumps(value, sort_keys=True)
+            elif name == 'typeclass':
+                value = TYPECLASSES.load_class(value).path
+            values[field] = value
+        return values
+
+    def run(self, nodes):
+        """
+        Import an iterable of flat nodes. Returns counts of created, updated and unchanged rows.
+        """
+        if TraitDefinitionDB.objects.filter(db_system=self.system, db_fullpath='').exists():
+            # Rows from before materialized paths would otherwise all match as ''.
+            TraitDefinitionDB.rebuild_fullpaths(self.system)
+        existing = {row['db_fullpath']: row for row in TraitDefinitionDB.objects.filter(db_system=self.system).values(
+            'id', 'db_fullpath', 'db_depth', *[field for field in self.fields.values()])}
+        identifiers = {row['db_system_identifier']: path for path, row in existing.items() if row['db_system_identifier']}
+
+        # Collect every node, then resolve parents. A parent may be referenced by
+        # identifier or path, and may appear later in a flat stream.
+        unresolved = list()
+        for node in nodes:
+            node['key'] = self.normalize(node['key'])
+            unresolved.append(node)
+        by_path = dict()
+        while unresolved:
+            waiting = list()
+            for node in unresolved:
+                if (parent := node.get('parent', None)):
+                    parent_path = identifiers.get(parent, None) or (parent if (parent in by_path or parent in existing) else None)
+                    if not parent_path:
+                        waiting.append(node)
+                        continue
+                    path = f"{parent_path}/{node['key']}"
+                else:
+                    parent_path, path = None, node['key']
+                node['_parent'] = parent_path
+                if path in by_path:
+                    raise ValueError(f"Duplicate TraitDefinition in import: {path}")
+                by_path[path] = node
+                if (identifier := node.get('identifier', None)):
+                    if (other := identifiers.get(identifier, None)) and other != path:
+                        raise ValueError(f"System identifier {identifier} is used by both {other} and {path}")
+                    identifiers[identifier] = path
+            if len(waiting) == len(unresolved):
+                raise ValueError(f"Cannot resolve parents: {', '.join(str(n.get('parent')) for n in waiting[:10])}")
+            unresolved = waiting
+
+        levels = dict()
+        depths = {path: row['db_depth'] for path, row in existing.items()}
+        for path in by_path:
+            levels.setdefault(self._depth(path, by_path, depths), list()).append(path)
+
+        ids = {path: row['id'] for path, row in existing.items()}
+        child_typeclasses = dict()
+        with transaction.atomic():
+            for depth in sorted(levels):
+                self._import_level(depth, levels[depth], by_path, existing, ids, child_typeclasses)
+
+        StorySystem.invalidate_definitions(self.system.id)
+        TYPECLASSES.clear()
+        return dict(self.stats)
+
+    def _depth(self, path, by_path, depths):
+        if (found := depths.get(path, None)) is None:
+            parent = by_path[path]['_parent']
+            found = self._depth(parent, by_path, depths) + 1 if parent else 0
+            depths[path] = found
+        return found
+
+    def _child_typeclass(self, path, by_path, existing, cache):
+        """
+        The typeclass path a new child of path should get, following inheritance upward.
+        """
+        if not path:
+            return TYPECLASSES.get_default_definition().path
+        if (found := cache.get(path, None)):
+            return found
+        if path in by_path and by_path[path].get('child_typeclass', None):
+            found = TYPECLASSES.load_class(by_path[path]['child_typeclass']).path
+        elif path in existing and existing[path]['db_child_default_typeclass']:
+            found = TYPECLASSES.load_class(existing[path]['db_child_default_typeclass']).path
+        else:
+            parent = by_path[path]['_parent'] if path in by_path else path.rsplit('/', 1)[0] if '/' in path else None
+            found = self._child_typeclass(parent, by_path, existing, cache)
+        cache[path] = found
+        return found
+
+    def _import_level(self, depth, paths, by_path, existing, ids, child_typeclasses):
+        creates, changes = list(), dict()
+        for path in paths:
+            node = by_path[path]
+            values = self._prepare(node)
+            parent_id = ids[node['_parent']] if node['_parent'] else None
+            if (row := existing.get(path, None)):
+                if (changed := {field: value for field, value in values.items() if row[field] != value}):
+                    changes[row['id']] = changed
+                else:
+                    self.stats['unchanged'] += 1
+                continue
+            typeclass = TYPECLASSES.load_class(values.pop('db_typeclass_path', None) or
+                                               self._child_typeclass(node['_parent'], by_path, existing, child_typeclasses))
+            creates.append(typeclass(db_system=self.system, db_key=node['key'], db_parent_id=parent_id,
+                                     db_fullpath=path, db_depth=depth, **values))
+
+        if creates:
+            TraitDefinitionDB.objects.bulk_create(creates, batch_size=self.batch_size)
+            self.stats['created'] += len(creates)
+            ids.update(TraitDefinitionDB.objects.filter(db_system=self.system, db_depth=depth)
+                       .values_list('db_fullpath', 'id'))
+        if changes:
+            rows = list(TraitDefinitionDB.objects.filter(id__in=list(changes)))
+            fields = set()
+            for row in rows:
+                for field, value in changes[row.id].items():
+                    setattr(row, field, value)
+                    fields.add(field)
+            TraitDefinitionDB.objects.bulk_update(rows, list(fields), batch_size=self.batch_size)
+            self.stats['updated'] += len(rows)
+            for row in rows:
+                TYPECLASSES.invalidate(row.id)
+                if 'db_typeclass_path' in changes[row.id]:
+                    # Let the idmapper load it again under its new typeclass.
+                    row.flush_from_cache(force=True)
@@ -0,0 +1,347 @@
+import json
+from bisect import bisect_left, bisect_right, insort
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'entries')
+
+    def __init__(self):
+        self.children = dict()
+        self.entries = list()
+
+
+class DefinitionEntry(object):
+    """
+    Lightweight, model-free record of a single TraitDefinition row.
+    """
+    __slots__ = ('id', 'key', 'ikey', 'parent_id', 'system_identifier', 'fullpath', 'depth', 'bonuses',
+                 'typeclass_path', 'trait_typeclass', 'child_typeclass', 'cost_rule', 'flags')
+
+    # Row layout, as read from the database or a DefinitionSnapshot.
+    fields = ('id', 'db_key', 'db_parent_id', 'db_system_identifier', 'db_fullpath', 'db_depth', 'db_bonuses',
+              'db_typeclass_path', 'db_trait_default_typeclass', 'db_child_default_typeclass', 'db_cost_rule',
+              'db_allow_context', 'db_require_context', 'db_can_specialize', 'db_can_roll',
+              'db_allow_zero', 'db_allow_buy', 'db_approved')
+
+    def __init__(self, id, key, parent_id, system_identifier, fullpath, depth, bonuses=None,
+                 typeclass_path=None, trait_typeclass=None, child_typeclass=None, cost_rule=None, *flags):
+        self.id = id
+        self.key = key
+        self.ikey = key.casefold()
+        self.parent_id = parent_id
+        self.system_identifier = system_identifier
+        self.fullpath = fullpath
+        self.depth = depth
+        self.bonuses = self.parse_bonuses(bonuses) if bonuses else None
+        self.typeclass_path = typeclass_path
+        self.trait_typeclass = trait_typeclass
+        self.child_typeclass = child_typeclass
+        self.cost_rule = self.parse_json('db_cost_rule', cost_rule) if cost_rule else None
+        self.flags = dict(zip(self.fields[11:], flags))
+
+    def parse_json(self, field, text):
+        try:
+            return json.loads(text)
+        except ValueError:
+            from evennia.utils.logger import log_err
+            log_err(f"TraitDefinition {self.id} has malformed {field}: {text}")
+            return None
+
+    def parse_bonuses(self, text):
+        if not (data := self.parse_json('db_bonuses', text)):
+            return None
+        rules = dict()
+        for identifier, rule in data.items():
+            rules[identifier] = (int(rule[0]), int(rule[1])) if isinstance(rule, list) else (int(rule), 0)
+        return rules or None
+
+    def get_bonuses(self, value):
+        """
+        Returns {target identifier: amount} granted by a Trait of this Definition at value.
+        """
+        if not self.bonuses:
+            return dict()
+        return {identifier: per_dot * value + flat for identifier, (per_dot, flat) in self.bonuses.items()}
+
+    def __str__(self):
+        return self.key
+
+
+class TraitDefinitionIndex(object):
+    """
+    In-memory lookup structures for one StorySystem's TraitDefinition tree.
+
+    Built lazily, from the system's DefinitionSnapshot when that is current or else from
+    a single values query (which then refreshes the snapshot), and thrown away whenever
+    a TraitDefinition in the system is saved or deleted. All lookups return
+    DefinitionEntry objects; use get_definition() to turn one into the typeclassed model
+    instance.
+    """
+
+    def __init__(self, system):
+        self.system = system
+        self._snapshot = None
+        self.generation = 0
+        self.loaded = False
+        self.entries = dict()
+        self.identifiers = dict()
+        self.children = dict()
+        self.exact = dict()
+        self.trie = _TrieNode()
+        self.ordered = list()
+        self.haystack = ''
+        self.starts = list()
+        self.roots = dict()
+
+    def invalidate(self):
+        self.loaded = False
+        self.entries = dict()
+        self.identifiers = dict()
+        self.children = dict()
+        self.exact = dict()
+        self.trie = _TrieNode()
+        self.ordered = list()
+        self.haystack = ''
+        self.starts = list()
+        self.roots = dict()
+
+    @property
+    def snapshot(self):
+        if self._snapshot is None:
+            from athanor_storyteller.snapshot import DefinitionSnapshot
+            self._snapshot = DefinitionSnapshot(self.system)
+        return self._snapshot
+
+    def read_rows(self):
+        checksum = self.snapshot.checksum()
+        if (rows := self.snapshot.read(checksum)) is not None:
+            return rows
+        rows = list(self.system.trait_definitions.values_list(*DefinitionEntry.fields))
+        self.snapshot.write(checksum, rows)
+        return rows
+
+    def load(self):
+        self.invalidate()
+        for row in self.read_rows():
+            entry = DefinitionEntry(*row)
+            self.entries[entry.id] = entry
+            if entry.system_identifier:
+                self.identifiers[entry.system_identifier] = entry
+        self.ordered = sorted(self.entries.values(), key=lambda e: (e.ikey, e.key))
+        for entry in self.ordered:
+            self.exact.setdefault(entry.ikey, list()).append(entry)
+            self.children.setdefault(entry.parent_id, list()).append(entry)
+            node = self.trie
+            for char in entry.ikey:
+                if not (next_node := node.children.get(char, None)):
+                    next_node = _TrieNode()
+                    node.children[char] = next_node
+                node = next_node
+                node.entries.append(entry)
+        for siblings in self.children.values():
+            siblings.sort(key=lambda e: (len(e.ikey), e.ikey))
+        # A NUL-joined blob of every folded key lets substring search run at C speed.
+        position = 0
+        for entry in self.ordered:
+            self.starts.append(position)
+            position += len(entry.ikey) + 1
+        self.haystack = '\x00'.join(entry.ikey for entry in self.ordered)
+        self.generation += 1
+        self.loaded = True
+
+    def _check(self):
+        if not self.loaded:
+            self.load()
+
+    def get(self, def_id):
+        self._check()
+        return self.entries.get(def_id, None)
+
+    def by_identifier(self, identifier):
+        self._check()
+        return self.identifiers.get(identifier, None)
+
+    def root_of(self, def_id):
+        """
+        Returns the top-level entry that a Definition sits under (itself, for a root).
+        """
+        self._check()
+        if (found := self.roots.get(def_id, None)) is None:
+            if not (entry := self.entries.get(def_id, None)):
+                return None
+            found = self.root_of(entry.parent_id) if entry.parent_id else entry
+            self.roots[def_id] = found
+        return found
+
+    def get_definition(self, entry):
+        """
+        Returns the typeclassed TraitDefinition for an entry or id, preferring the idmapper cache.
+        """
+        from athanor_storyteller.models import TraitDefinitionDB
+        def_id = entry if isinstance(entry, int) else entry.id
+        if (found := TraitDefinitionDB.get_cached_instance(def_id)):
+            return found
+        return self.system.trait_definitions.get(id=def_id)
+
+    def fullpath(self, entry):
+        if entry.fullpath:
+            return entry.fullpath
+        self._check()
+        full = list()
+        while entry:
+            full.append(entry.key)
+            entry = self.entries.get(entry.parent_id, None)
+        return '/'.join(reversed(full))
+
+    def find_exact(self, text):
+        self._check()
+        return list(self.exact.get(text.casefold(), list()))
+
+    def find_prefix(self, text):
+        self._check()
+        node = self.trie
+        for char in text.casefold():
+            if not (node := node.children.get(char, None)):
+                return list()
+        return list(node.entries)
+
+    def find_contains(self, text):
+        self._check()
+        text = text.casefold()
+        if not text:
+            return list(self.ordered)
+        found = list()
+        position = self.haystack.find(text)
+        while position != -1:
+            index = bisect_right(self.starts, position) - 1
+            found.append(self.ordered[index])
+            if index + 1 >= len(self.starts):
+                break
+            position = self.haystack.find(text, self.starts[index + 1])
+        return found
+
+    def quick_find(self, text):
+        """
+        Mirrors the old iexact -> istartswith -> icontains cascade.
+        """
+        if (found := self.find_exact(text)):
+            return found
+        if (found := self.find_prefix(text)):
+            return found
+        return self.find_contains(text)
+
+    def find_child(self, parent, text):
+        """
+        Partial-match a name among the direct children of parent (None for the roots).
+        An exact match always wins; a prefix shared by several children raises ValueError.
+        """
+        self._check()
+        folded = text.casefold()
+        if not (found := [entry for entry in self.children.get(parent.id if parent else None, list())
+                          if entry.ikey.startswith(folded)]):
+            return None
+        if len(found) > 1 and found[0].ikey != folded:
+            raise ValueError(f"{text} matched {', '.join(self.fullpath(entry) for entry in found)}. Please be more exact.")
+        return found[0]
+
+    def find_path(self, path):
+        """
+        Exact, case-insensitive lookup of a '/'-separated path of keys.
+        """
+        self._check()
+        found = None
+        for name in path.split('/'):
+            name = name.strip().casefold()
+            siblings = self.children.get(found.id if found else None, list())
+            if not (found := next((entry for entry in siblings if entry.ikey == name), None)):
+                return None
+        return found
+
+    def get_children(self, parent):
+        self._check()
+        return list(self.children.get(parent.id if parent else None, list()))
+
+
+class PersonaDirectory(object):
+    """
+    Per-Object directory of Persona names (db_ikey) to (Persona id, StorySystem id) pairs.
+
+    An Object's entry is loaded with one values query the first time it is searched,
+    kept as a sorted name list for bisect prefix lookups, and then maintained by the
+    controller's create/rename/delete operations. Personas made any other way (directly,
+    by import, through the admin) are picked up because a search that finds nothing
+    re-reads the Object's entry once before giving up.
+    """
+
+    def __init__(self):
+        self.objects = dict()
+
+    def _get(self, obj_id, refresh=False):
+        from athanor_storyteller.models import PersonaDB
+        if refresh or (found := self.objects.get(obj_id, None)) is None:
+            names = dict()
+            for persona_id, system_id, ikey in PersonaDB.objects.filter(db_object_id=obj_id).values_list(
+                    'id', 'db_system_id', 'db_ikey'):
+                names.setdefault(ikey, list()).append((persona_id, system_id))
+            found = (sorted(names), names)
+            self.objects[obj_id] = found
+        return found
+
+    def count(self, obj):
+        if not (found := sum(len(ids) for ids in self._get(obj.id)[1].values())):
+            found = sum(len(ids) for ids in self._get(obj.id, refresh=True)[1].values())
+        return found
+
+    def _find(self, keys, names, name, system_id):
+        if (found := names.get(name, None)):
+            found = [persona_id for persona_id, persona_system in found if system_id in (None, persona_system)]
+            if found:
+                return found
+        found = list()
+        position = bisect_left(keys, name)
+        while position < len(keys) and keys[position].startswith(name):
+            found.extend(persona_id for persona_id, persona_system in names[keys[position]]
+                         if system_id in (None, persona_system))
+            position += 1
+        return found
+
+    def find(self, obj, name, system=None):
+        """
+        Returns the ids of Personas on obj named name, or failing that, whose names start
+        with it. Only Personas of system count, if one is given.
+        """
+        name = name.lower()
+        system_id = system.id if system else None
+        if not (found := self._find(*self._get(obj.id), name, system_id)):
+            found = self._find(*self._get(obj.id, refresh=True), name, system_id)
+        return found
+
+    def get_persona(self, persona_id):
+        from athanor_storyteller.models import PersonaDB
+        if (found := PersonaDB.get_cached_instance(persona_id)):
+            return found
+        return PersonaDB.objects.get(id=persona_id)
+
+    def add(self, persona):
+        if (found := self.objects.get(persona.db_object_id, None)) is None:
+            return
+        keys, names = found
+        if persona.db_ikey not in names:
+            insort(keys, persona.db_ikey)
+        names.setdefault(persona.db_ikey, list()).append((persona.id, persona.db_system_id))
+
+    def remove(self, persona, ikey=None):
+        if (found := self.objects.get(persona.db_object_id, None)) is None:
+            return
+        keys, names = found
+        ikey = ikey or persona.db_ikey
+        if (ids := names.get(ikey, None)) is None:
+            return
+        ids[:] = [pair for pair in ids if pair[0] != persona.id]
+        if not ids:
+            del names[ikey]
+            keys.remove(ikey)
+
+    def rename(self, persona, old_ikey):
+        self.remove(persona, old_ikey)
+        self.add(persona)
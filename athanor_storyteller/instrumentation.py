@@ -0,0 +1,127 @@
+import json
+import time
+from bisect import bisect_left
+from collections import deque
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+from evennia.utils.logger import log_file
+
+from athanor_storyteller.cache import CACHE
+
+# Upper bounds, in milliseconds, of the wall-time histogram buckets. The last is open.
+BUCKETS = (1, 5, 10, 50, 100, 500, 1000)
+
+
+class _QueryCounter(object):
+    __slots__ = ('count',)
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class Metrics(object):
+    """
+    Rolling per-operation measurements: wall time, ORM query count and persona cache
+    hits and misses of the last window calls of each instrumented operation.
+
+    Off unless settings.STORYTELLER_INSTRUMENT is True (or enable() is called); while
+    off, an instrumented call costs one attribute check.
+    """
+
+    def __init__(self):
+        self.enabled = None
+        self.samples = dict()
+
+    @property
+    def window(self):
+        return getattr(settings, 'STORYTELLER_INSTRUMENT_WINDOW', 1000)
+
+    @property
+    def log_name(self):
+        return getattr(settings, 'STORYTELLER_INSTRUMENT_LOG', 'storyteller_metrics.log')
+
+    def check(self):
+        if self.enabled is None:
+            self.enabled = getattr(settings, 'STORYTELLER_INSTRUMENT', False)
+        return self.enabled
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.samples = dict()
+
+    def record(self, name, wall, queries, hits, misses):
+        if (found := self.samples.get(name, None)) is None:
+            found = deque(maxlen=self.window)
+            self.samples[name] = found
+        found.append((wall, queries, hits, misses))
+
+    def measure(self, name, func, args, kwargs):
+        counter = _QueryCounter()
+        hits, misses = CACHE.hits, CACHE.misses
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(counter):
+                return func(*args, **kwargs)
+        finally:
+            self.record(name, time.perf_counter() - start, counter.count, CACHE.hits - hits, CACHE.misses - misses)
+
+    def summary(self, name):
+        if not (found := self.samples.get(name, None)):
+            return None
+        walls = sorted(sample[0] * 1000 for sample in found)
+        queries = sorted(sample[1] for sample in found)
+        histogram = [0] * (len(BUCKETS) + 1)
+        for wall in walls:
+            histogram[bisect_left(BUCKETS, wall)] += 1
+        return {
+            'name': name,
+            'calls': len(found),
+            'wall_ms': {'mean': sum(walls) / len(walls), 'p50': walls[len(walls) // 2],
+                        'p95': walls[int(len(walls) * 0.95)], 'max': walls[-1]},
+            'queries': {'mean': sum(queries) / len(queries), 'p95': queries[int(len(queries) * 0.95)],
+                        'max': queries[-1]},
+            'cache': {'hits': sum(sample[2] for sample in found), 'misses': sum(sample[3] for sample in found)},
+            'histogram': dict(zip([f"<={bound}ms" for bound in BUCKETS] + [f">{BUCKETS[-1]}ms"], histogram)),
+        }
+
+    def summaries(self):
+        return [self.summary(name) for name in sorted(self.samples)]
+
+    def export(self):
+        """
+        Writes one JSON line per operation to the instrumentation log. Returns how many.
+        """
+        found = self.summaries()
+        stamp = time.time()
+        for summary in found:
+            summary['time'] = stamp
+            log_file(json.dumps(summary, sort_keys=True), filename=self.log_name)
+        return len(found)
+
+
+METRICS = Metrics()
+
+
+def instrumented(name):
+    """
+    Decorator that records each call of the wrapped function in METRICS under name.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not (METRICS.enabled or (METRICS.enabled is None and METRICS.check())):
+                return func(*args, **kwargs)
+            return METRICS.measure(name, func, args, kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,180 @@
+import json
+from datetime import timedelta
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import transaction
+
+from evennia.utils.logger import log_err
+
+from athanor.utils.time import utcnow
+
+from athanor_storyteller.buffers import BatchBuffer
+from athanor_storyteller.models import TraitJournalDB, PersonaSnapshotDB
+
+
+class TraitJournal(BatchBuffer):
+    """
+    Buffers TraitJournalDB rows and writes them with bulk_create. Each Persona gets a
+    PersonaSnapshotDB taken from its sheet once every snapshot_every journal entries,
+    which bounds how much history sheet_at() has to replay. The first time a Persona
+    with no snapshot at all is journaled, a baseline of its sheet from just before that
+    change is written too, so Traits that predate journaling are never lost. How many
+    entries a Persona has had since its last snapshot is read from the database the
+    first time it is journaled in a process, so reloads don't reset the cadence.
+
+    While the database refuses writes, at most STORYTELLER_JOURNAL_LIMIT entries are
+    held; the oldest past that are dropped, and how many is logged.
+    """
+    interval_setting = 'STORYTELLER_JOURNAL_INTERVAL'
+    threshold_setting = 'STORYTELLER_JOURNAL_THRESHOLD'
+    limit_setting = 'STORYTELLER_JOURNAL_LIMIT'
+    default_interval = 30
+    default_threshold = 1000
+    default_limit = 50000
+
+    def __init__(self):
+        super().__init__()
+        self.pending = list()
+        self.personas = dict()
+        self.baselines = list()
+        self.since_snapshot = dict()
+        self.enactor = ContextVar('storyteller_enactor', default=None)
+
+    def __len__(self):
+        return len(self.pending)
+
+    @property
+    def snapshot_every(self):
+        from django.conf import settings
+        return getattr(settings, 'STORYTELLER_JOURNAL_SNAPSHOT_EVERY', 200)
+
+    @contextmanager
+    def acting(self, enactor):
+        """
+        Attribute every entry recorded inside the block to enactor.
+        """
+        token = self.enactor.set(enactor.id if enactor else None)
+        try:
+            yield
+        finally:
+            self.enactor.reset(token)
+
+    def _track(self, persona, definition_id, context, old_value, kind, now):
+        """
+        Start counting entries for a Persona seen for the first time in this process.
+        """
+        if (last := PersonaSnapshotDB.objects.filter(db_persona=persona.id).order_by('-db_date_created')
+                .values_list('db_date_created', flat=True).first()):
+            self.since_snapshot[persona.id] = TraitJournalDB.objects.filter(
+                db_persona=persona.id, db_date_created__gt=last).count()
+            return
+        if any(snapshot.db_persona == persona.id for snapshot in self.baselines):
+            return
+        # The sheet already holds this change, so put the old value back for the baseline.
+        state = {(def_id, context_.lower()): [def_id, context_, base, damage]
+                 for def_id, context_, base, damage in persona.sheet.display_entries()}
+        if definition_id is not None and kind in (TraitJournalDB.KIND_VALUE, TraitJournalDB.KIND_DAMAGE):
+            key = (definition_id, (context or '').lower())
+            if kind == TraitJournalDB.KIND_DAMAGE:
+                if key in state:
+                    state[key][3] = old_value or 0
+            elif old_value is None:
+                state.pop(key, None)
+            else:
+                state.setdefault(key, [definition_id, context, 0, 0])[2] = old_value
+        self.baselines.append(PersonaSnapshotDB(db_persona=persona.id, db_date_created=now - timedelta(microseconds=1),
+                                                db_data=json.dumps(list(state.values()))))
+        self.since_snapshot[persona.id] = 0
+
+    def record(self, persona, definition_id, context, old_value, new_value, kind=TraitJournalDB.KIND_VALUE):
+        now = utcnow()
+        if kind != TraitJournalDB.KIND_DELETE and persona.id not in self.since_snapshot:
+            self._track(persona, definition_id, context, old_value, kind, now)
+        self.pending.append(TraitJournalDB(db_persona=persona.id, db_definition=definition_id, db_context=context,
+                                           db_old_value=old_value, db_new_value=new_value, db_kind=kind,
+                                           db_enactor=self.enactor.get(), db_date_created=now))
+        if kind == TraitJournalDB.KIND_DELETE:
+            self.personas.pop(persona.id, None)
+            self.since_snapshot.pop(persona.id, None)
+        else:
+            self.personas[persona.id] = persona
+            self.since_snapshot[persona.id] = self.since_snapshot.get(persona.id, 0) + 1
+        self.check()
+
+    def _flush(self):
+        pending, self.pending = self.pending, list()
+        personas, self.personas = self.personas, dict()
+        baselines, self.baselines = self.baselines, list()
+        snapshots = list()
+        for persona_id, persona in personas.items():
+            if self.since_snapshot.get(persona_id, 0) < self.snapshot_every:
+                continue
+            data = [list(entry) for entry in persona.sheet.display_entries()]
+            snapshots.append(PersonaSnapshotDB(db_persona=persona_id, db_date_created=utcnow(), db_data=json.dumps(data)))
+        try:
+            with transaction.atomic():
+                if baselines:
+                    PersonaSnapshotDB.objects.bulk_create(baselines, batch_size=500)
+                TraitJournalDB.objects.bulk_create(pending, batch_size=500)
+                if snapshots:
+                    PersonaSnapshotDB.objects.bulk_create(snapshots, batch_size=500)
+        except Exception:
+            # Keep the entries, in order, for the next attempt.
+            self.pending = pending + self.pending
+            self.baselines = baselines + self.baselines
+            personas.update(self.personas)
+            self.personas = personas
+            raise
+        for snapshot in snapshots:
+            self.since_snapshot[snapshot.db_persona] = 0
+
+    def trim(self, count):
+        self.pending = self.pending[count:]
+        log_err(f"Trait journal could not be written; dropped the {count} oldest entries.")
+
+    def abandon(self):
+        log_err(f"Trait journal could not be written at shutdown; lost {len(self.pending)} entries.")
+        self.pending, self.baselines, self.personas = list(), list(), dict()
+
+    def history(self, persona_id, start=None, end=None):
+        self.flush()
+        entries = TraitJournalDB.objects.filter(db_persona=persona_id)
+        if start:
+            entries = entries.filter(db_date_created__gte=start)
+        if end:
+            entries = entries.filter(db_date_created__lte=end)
+        return entries.order_by('db_date_created', 'id')
+
+    def sheet_at(self, persona_id, when):
+        """
+        Rebuild a Persona's sheet as it stood at when, from the latest snapshot at or
+        before that moment plus the journal entries written since.
+
+        Returns:
+            sheet (list): (definition id, context, base value, damage value) tuples.
+        """
+        self.flush()
+        state = dict()
+        entries = TraitJournalDB.objects.filter(db_persona=persona_id, db_date_created__lte=when,
+                                                db_kind__in=(TraitJournalDB.KIND_VALUE, TraitJournalDB.KIND_DAMAGE))
+        if (snapshot := PersonaSnapshotDB.objects.filter(db_persona=persona_id, db_date_created__lte=when)
+                .order_by('-db_date_created').first()):
+            for def_id, context, base, damage in json.loads(snapshot.db_data):
+                state[(def_id, context.lower())] = [def_id, context, base, damage]
+            entries = entries.filter(db_date_created__gt=snapshot.db_date_created)
+        for def_id, context, new_value, kind in entries.order_by('db_date_created', 'id').values_list(
+                'db_definition', 'db_context', 'db_new_value', 'db_kind'):
+            key = (def_id, context.lower())
+            if kind == TraitJournalDB.KIND_DAMAGE:
+                if key in state:
+                    state[key][3] = new_value or 0
+            elif new_value is None:
+                state.pop(key, None)
+            else:
+                state.setdefault(key, [def_id, context, 0, 0])
+                state[key][1], state[key][2] = context, new_value
+        return [tuple(row) for row in state.values()]
+
+
+JOURNAL = TraitJournal()
@@ -0,0 +1,30 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from athanor_storyteller.models import StorySystem
+from athanor_storyteller.transfer import PersonaExporter
+
+
+class Command(BaseCommand):
+    help = "Export Persona sheets (traits, marks and pools) as JSON Lines, one Persona per line."
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', default='-', help="File to write, or - for stdout.")
+        parser.add_argument('--system', action='append', dest='systems', default=list(),
+                            help="Only export Personas of this Story System. May be repeated.")
+        parser.add_argument('--chunk-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        systems = list()
+        for key in options['systems']:
+            if not (found := StorySystem.objects.filter(db_key__iexact=key).first()):
+                raise CommandError(f"Story System '{key}' not found!")
+            systems.append(found)
+        exporter = PersonaExporter(systems=systems, chunk_size=options['chunk_size'])
+        if options['output'] == '-':
+            exporter.write(sys.stdout)
+            return
+        with open(options['output'], 'w') as stream:
+            count = exporter.write(stream)
+        self.stderr.write(f"Exported {count} Personas to {options['output']}.")
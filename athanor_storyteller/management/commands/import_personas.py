@@ -0,0 +1,28 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from athanor_storyteller.transfer import PersonaImporter
+
+
+class Command(BaseCommand):
+    help = "Import Persona sheets from JSON Lines written by export_personas."
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', nargs='?', default='-', help="File to read, or - for stdin.")
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--max-errors', type=int, default=50, help="How many problems to list.")
+
+    def handle(self, *args, **options):
+        importer = PersonaImporter(batch_size=options['batch_size'])
+        if options['input'] == '-':
+            stats = importer.run(importer.read(sys.stdin))
+        else:
+            with open(options['input'], 'r') as stream:
+                stats = importer.run(importer.read(stream))
+        for error in importer.errors[:options['max_errors']]:
+            self.stderr.write(error)
+        if (hidden := len(importer.errors) - options['max_errors']) > 0:
+            self.stderr.write(f"...and {hidden} more problems.")
+        self.stdout.write(f"Imported {stats['personas']} Personas with {stats['traits']} Traits and "
+                          f"{stats['pools']} Pools; skipped {stats['skipped']}.")
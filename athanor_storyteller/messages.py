@@ -0,0 +1,152 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from evennia.utils.logger import log_trace
+
+
+class MessageDispatcher(object):
+    """
+    Delivers StorytellerMessages. Inside a collect() block, messages are only queued;
+    when the block ends they are de-duplicated and grouped per recipient, each group of
+    like messages is collapsed into one summary line, and every recipient gets a single
+    msg() call. Outside a block, messages are delivered as they are sent.
+    """
+
+    def __init__(self):
+        self.batch = ContextVar('storyteller_messages', default=None)
+        self.channel = None
+
+    @contextmanager
+    def collect(self):
+        if self.batch.get() is not None:
+            # Nested operations join the outermost batch.
+            yield
+            return
+        token = self.batch.set(list())
+        try:
+            yield
+            messages = self.batch.get()
+        finally:
+            self.batch.reset(token)
+        self.deliver(messages)
+
+    def send(self, message):
+        if (batch := self.batch.get()) is not None:
+            batch.append(message)
+        else:
+            self.deliver([message])
+
+    def get_channel(self):
+        if self.channel is None and (key := getattr(settings, 'STORYTELLER_CHANNEL', None)):
+            from evennia.utils.search import search_channel
+            self.channel = found[0] if (found := search_channel(key)) else None
+        return self.channel
+
+    def deliver(self, messages):
+        recipients = dict()
+        for message in messages:
+            for recipient, template in message.recipients(self):
+                seen, groups = recipients.setdefault(recipient, (set(), dict()))
+                if (key := message.dedupe_key(template)) in seen:
+                    continue
+                seen.add(key)
+                group = (message.__class__, template, message.entities.get(message.group_by, None))
+                groups.setdefault(group, list()).append(message)
+        for recipient, (seen, groups) in recipients.items():
+            lines = list()
+            for (message_class, template, grouped_by), group in groups.items():
+                if len(group) == 1:
+                    lines.append(group[0].format(template))
+                else:
+                    lines.append(message_class.summarize(group, template))
+            try:
+                recipient.msg('\n'.join(lines))
+            except Exception:
+                log_trace()
+
+
+DISPATCHER = MessageDispatcher()
+collect = DISPATCHER.collect
+
+
+class StorytellerMessage(object):
+    """
+    A notification about an operation on a Persona. entities holds 'enactor' (an Account)
+    and 'target' (a Persona); kwargs are extra format fields. Nothing is formatted
+    until delivery. A batch summarizes like messages that share the group_by entity.
+    """
+    group_by = 'target'
+    enactor_message = None
+    target_message = None
+    channel_message = None
+    summary_message = "{enactor} made {count} changes to {target}."
+
+    def __init__(self, entities, **kwargs):
+        self.entities = entities
+        self.kwargs = kwargs
+
+    def send(self):
+        DISPATCHER.send(self)
+
+    def recipients(self, dispatcher):
+        if self.enactor_message and (enactor := self.entities.get('enactor', None)):
+            yield enactor, self.enactor_message
+        if self.target_message and (target := self.entities.get('target', None)):
+            yield target.db_object, self.target_message
+        if self.channel_message and (channel := dispatcher.get_channel()):
+            yield channel, self.channel_message
+
+    def dedupe_key(self, template):
+        return (self.__class__, template, tuple(sorted((k, str(v)) for k, v in self.entities.items())),
+                tuple(sorted((k, str(v)) for k, v in self.kwargs.items())))
+
+    def fields(self):
+        fields = {key: str(value) for key, value in self.entities.items()}
+        fields.update({key: str(value) for key, value in self.kwargs.items()})
+        return fields
+
+    def format(self, template):
+        return template.format(**self.fields())
+
+    @classmethod
+    def summarize(cls, messages, template):
+        fields = messages[0].fields()
+        fields['count'] = len(messages)
+        return cls.summary_message.format(**fields)
+
+
+class Create(StorytellerMessage):
+    group_by = 'enactor'
+    enactor_message = "You created Persona {target}."
+    channel_message = "{enactor} created Persona {target}."
+    summary_message = "{enactor} created {count} Personas."
+
+
+class Rename(StorytellerMessage):
+    group_by = 'enactor'
+    enactor_message = "You renamed Persona {old_name} to {target}."
+    target_message = "Your Persona {old_name} is now called {target}."
+    channel_message = "{enactor} renamed Persona {old_name} to {target}."
+    summary_message = "{enactor} renamed {count} Personas."
+
+
+class Delete(StorytellerMessage):
+    group_by = 'enactor'
+    enactor_message = "You deleted Persona {target}."
+    target_message = "Your Persona {target} was deleted."
+    channel_message = "{enactor} deleted Persona {target}."
+    summary_message = "{enactor} deleted {count} Personas."
+
+
+class Template(StorytellerMessage):
+    enactor_message = "You changed {target}'s template from {old_template} to {template}."
+    target_message = "{target}'s template is now {template}."
+    channel_message = "{enactor} changed {target}'s template from {old_template} to {template}."
+
+
+class TraitSet(StorytellerMessage):
+    enactor_message = "You set {target}'s {trait} to {value}."
+    target_message = "{target}'s {trait} is now {value}."
+    channel_message = "{enactor} set {target}'s {trait} to {value}."
+    summary_message = "{enactor} changed {count} traits on {target}."
@@ -6,4 +6,13 @@ class StorytellerCharacterMixin(object):
 
     @lazy_property
     def persona(self):
-        return PersonaHandler(self)
\ No newline at end of file
+        return PersonaHandler(self)
+
+    def at_post_puppet(self, **kwargs):
+        super().at_post_puppet(**kwargs)
+        self.persona.load()
+
+    def at_post_unpuppet(self, account=None, session=None, **kwargs):
+        super().at_post_unpuppet(account=account, session=session, **kwargs)
+        if not self.sessions.count():
+            self.persona.release()
@@ -1,11 +1,50 @@
-from evennia.utils.utils import class_from_module
-from django.db import models
+from evennia.utils.utils import lazy_property
+from django.db import models, transaction
+from django.db.models import F, Q, Value
+from django.db.models.functions import Concat, Substr
 from evennia.typeclasses.models import TypedObject, SharedMemoryModel
+from athanor_storyteller.registry import TYPECLASSES
 
 
 class StorySystem(SharedMemoryModel):
     db_key = models.CharField(max_length=255, null=False, blank=False, unique=True)
 
+    # Bumped whenever the system's TraitDefinitions change; part of the DefinitionSnapshot checksum.
+    db_revision = models.PositiveIntegerField(default=0, null=False)
+
+    @lazy_property
+    def definitions(self):
+        from athanor_storyteller.indexes import TraitDefinitionIndex
+        return TraitDefinitionIndex(self)
+
+    @lazy_property
+    def costs(self):
+        from athanor_storyteller.costs import CostEngine
+        return CostEngine(self)
+
+    @property
+    def pool_identifiers(self):
+        """
+        Every Trait system identifier that some PoolDefinition's maximum is computed from.
+        """
+        if (found := getattr(self, '_pool_identifiers', None)) is None:
+            found = set()
+            for traits in self.pool_definitions.values_list('db_maximum_traits', flat=True):
+                found.update(identifier.strip() for identifier in traits.split(',') if identifier.strip())
+            self._pool_identifiers = found
+        return found
+
+    @classmethod
+    def invalidate_definitions(cls, system_id):
+        """
+        Drops the in-memory TraitDefinition index of a system, if it has been loaded, and
+        bumps the revision so its DefinitionSnapshot is rewritten on the next load.
+        """
+        cls.objects.filter(id=system_id).update(db_revision=F('db_revision') + 1)
+        if (system := cls.get_cached_instance(system_id)):
+            system.db_revision = cls.objects.filter(id=system_id).values_list('db_revision', flat=True).first()
+            system.definitions.invalidate()
+
 
 class PersonaDB(TypedObject):
     """
@@ -36,6 +75,8 @@ class TraitDefinitionDB(TypedObject):
     """
     TraitDefinitions are the 'rules' and structure for Abilities, Charms, Disciplines, Attributes, etc.
     """
+    _typeclass_fields = {'db_parent', 'db_parent_id', 'db_trait_default_typeclass', 'db_child_default_typeclass'}
+
     __settingclasspath__ = "athanor_storyteller.traits.DefaultTraitDefinition"
     __defaultclasspath__ = "athanor_storyteller.traits.DefaultTraitDefinition"
     __applabel__ = "athanor_storyteller"
@@ -44,6 +85,11 @@ class TraitDefinitionDB(TypedObject):
     # db_key is used as a sort of per-parent unique identifier for when traversing the tree.
     db_parent = models.ForeignKey('self', related_name='children', null=True, on_delete=models.PROTECT)
 
+    # Materialized '/'-joined path of keys from the root, and how many parents lie above this
+    # Definition. Both are maintained by save() so that fullpath() never walks db_parent.
+    db_fullpath = models.TextField(null=False, blank=True, default='')
+    db_depth = models.PositiveIntegerField(default=0, null=False, db_index=True)
+
     # The system identifier is a string used to identify this trait in the database for the plugin
     # system to get-create-update it. this is usually a flat and simple string, like attribute_strength
     # This identifier will also be used for bonuses and other purposes.
@@ -72,6 +118,14 @@ class TraitDefinitionDB(TypedObject):
     # only serves as a 'Category' parent.
     db_allow_buy = models.BooleanField(default=True, null=False)
 
+    # JSON object of bonuses that a Trait of this Definition grants to others, keyed by the target's
+    # system identifier. An integer value is granted per dot; a [per_dot, flat] pair adds a flat amount.
+    db_bonuses = models.TextField(null=True, blank=True)
+
+    # JSON experience cost rule (see athanor_storyteller.costs). Inherited by descendants
+    # that have none of their own.
+    db_cost_rule = models.TextField(null=True, blank=True)
+
     # Marks whether this trait has been approved by staff or not. This only affects the UI
     # experience during Chargen. Relevant only for traits created during play.
     db_approved = models.BooleanField(default=True, null=False)
@@ -79,7 +133,51 @@ class TraitDefinitionDB(TypedObject):
     def __str__(self):
         return str(self.db_key)
 
+    def update_fullpath(self):
+        if (parent := self.db_parent):
+            self.db_fullpath = f"{parent.fullpath()}/{self.db_key}"
+            self.db_depth = parent.db_depth + 1
+        else:
+            self.db_fullpath = str(self.db_key)
+            self.db_depth = 0
+
+    def save(self, *args, **kwargs):
+        old_path, old_depth = self.db_fullpath, self.db_depth
+        self.update_fullpath()
+        if (update_fields := kwargs.get('update_fields', None)) is not None:
+            kwargs['update_fields'] = set(update_fields) | {'db_fullpath', 'db_depth'}
+        super().save(*args, **kwargs)
+        if old_path and old_path != self.db_fullpath:
+            self.update_descendant_paths(old_path, old_depth)
+        if update_fields is None or self._typeclass_fields.intersection(update_fields):
+            TYPECLASSES.invalidate(self.id)
+        StorySystem.invalidate_definitions(self.db_system_id)
+
+    def update_descendant_paths(self, old_path, old_depth):
+        """
+        Rewrites the stored paths of every descendant after a rename or reparent, with a
+        single UPDATE plus an in-place patch of any instances the idmapper is holding.
+        """
+        prefix = f"{old_path}/"
+        new_prefix = f"{self.db_fullpath}/"
+        shift = self.db_depth - old_depth
+        TraitDefinitionDB.objects.filter(db_system_id=self.db_system_id, db_fullpath__startswith=prefix).update(
+            db_fullpath=Concat(Value(new_prefix), Substr('db_fullpath', len(prefix) + 1), output_field=models.TextField()),
+            db_depth=F('db_depth') + shift)
+        for cached in TraitDefinitionDB.get_all_cached_instances():
+            if cached.db_system_id == self.db_system_id and cached.db_fullpath.startswith(prefix):
+                cached.db_fullpath = new_prefix + cached.db_fullpath[len(prefix):]
+                cached.db_depth += shift
+
+    def delete(self):
+        def_id, system_id = self.id, self.db_system_id
+        super().delete()
+        TYPECLASSES.invalidate(def_id)
+        StorySystem.invalidate_definitions(system_id)
+
     def fullpath(self):
+        if self.db_fullpath:
+            return self.db_fullpath
         par = self.db_parent
         full = [self]
         while par:
@@ -87,13 +185,43 @@ class TraitDefinitionDB(TypedObject):
             par = par.db_parent
         return '/'.join(str(trait) for trait in reversed(full))
 
+    @classmethod
+    def bulk_fullpaths(cls, queryset):
+        """
+        Returns {id: fullpath} for every TraitDefinition in queryset using one query.
+        """
+        return dict(queryset.values_list('id', 'db_fullpath'))
+
+    @classmethod
+    def rebuild_fullpaths(cls, system):
+        """
+        Recomputes db_fullpath and db_depth for a whole StorySystem in memory and writes
+        them back in bulk. Useful for rows that predate the materialized path.
+        """
+        definitions = {definition.id: definition for definition in cls.objects.filter(db_system=system)}
+        paths = dict()
+
+        def resolve(definition):
+            if definition.id not in paths:
+                if (parent := definitions.get(definition.db_parent_id, None)):
+                    parent_path, parent_depth = resolve(parent)
+                    paths[definition.id] = (f"{parent_path}/{definition.db_key}", parent_depth + 1)
+                else:
+                    paths[definition.id] = (str(definition.db_key), 0)
+            return paths[definition.id]
+
+        for definition in definitions.values():
+            definition.db_fullpath, definition.db_depth = resolve(definition)
+        cls.objects.bulk_update(list(definitions.values()), ['db_fullpath', 'db_depth'], batch_size=500)
+        StorySystem.invalidate_definitions(system.id)
+
     @property
     def trait_typeclass(self):
-        if not (default := self.db_trait_default_typeclass) and not self.db_parent:
-            return self.__class__
-        if default:
-            return class_from_module(default)
-        return self.db_parent.trait_typeclass
+        return TYPECLASSES.trait_typeclass(self)
+
+    @property
+    def child_typeclass(self):
+        return TYPECLASSES.child_typeclass(self)
 
     class Meta:
         unique_together = (('db_system', 'db_parent', 'db_key'), ('db_system', 'db_system_identifier'))
@@ -117,8 +245,15 @@ class TraitDB(TypedObject):
     db_base_value = models.BigIntegerField(default=0, null=False, blank=False)
     db_damage_value = models.BigIntegerField(default=0, null=False, blank=False)
 
+    # Bitfield of marks (favored, caste, etc). Bit N is the Nth entry of the Definition
+    # typeclass's can_mark list.
+    db_marks = models.BigIntegerField(default=0, null=False, blank=False)
+
     class Meta:
-        unique_together = (('db_persona', 'db_trait', 'db_icontext'),)
+        unique_together = (('db_persona', 'db_trait_definition', 'db_icontext'),)
+        indexes = [models.Index(fields=['db_persona', 'db_marks']),
+                   models.Index(fields=['db_trait_definition', 'db_base_value']),
+                   models.Index(fields=['db_trait_definition', 'db_icontext', 'db_base_value'])]
         verbose_name = 'Trait'
         verbose_name_plural = 'Traits'
 
@@ -127,20 +262,111 @@ class TraitDB(TypedObject):
             return f"{self.db_trait_definition.fullpath()}: {self.db_context}"
         return self.db_trait_definition.fullpath()
 
+    @classmethod
+    def bulk_fullpaths(cls, queryset):
+        """
+        Returns {id: fullpath} for every Trait in queryset using one joined query.
+        """
+        return {trait_id: f"{path}: {context}" if context else path
+                for trait_id, path, context in queryset.values_list('id', 'db_trait_definition__db_fullpath', 'db_context')}
+
+    @classmethod
+    def filter_marked(cls, mark, queryset=None):
+        """
+        Narrow a Trait queryset (every Trait by default) to those carrying a mark.
+
+        Different Definition typeclasses may keep the same mark at different bits, so
+        this groups Definition typeclasses by bit and tests each group with a bitwise AND.
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+        groups = dict()
+        for path in TraitDefinitionDB.objects.values_list('db_typeclass_path', flat=True).distinct():
+            try:
+                typeclass = TYPECLASSES.load_class(path)
+            except Exception:
+                continue
+            if mark in getattr(typeclass, 'can_mark', ()):
+                groups.setdefault(typeclass.mark_bit(mark), list()).append(path)
+        if not groups:
+            return queryset.none()
+        condition = Q()
+        queryset = queryset.filter(db_marks__gt=0)
+        for bit, paths in groups.items():
+            queryset = queryset.annotate(**{f"marks_{bit}": F('db_marks').bitand(bit)})
+            condition |= Q(**{f"marks_{bit}__gt": 0, 'db_trait_definition__db_typeclass_path__in': paths})
+        return queryset.filter(condition)
+
+    @classmethod
+    def backfill_marks(cls, system=None, chunk_size=500):
+        """
+        Moves marks still held in the old pickled 'marked' Attribute into db_marks and
+        deletes those Attributes. Run once after upgrading; it is safe to repeat.
+
+        Returns:
+            moved (int), errors (list): How many Traits were updated, and any marks their
+                Definition typeclass no longer allows (those are dropped).
+        """
+        from evennia.typeclasses.attributes import Attribute
+        from athanor_storyteller.buffers import WRITE_BEHIND
+        WRITE_BEHIND.flush()
+        attributes = Attribute.objects.filter(db_key='marked', traitdb__isnull=False)
+        if system:
+            attributes = attributes.filter(traitdb__db_persona__db_system=system)
+        pairs = list(attributes.order_by('id').values_list('id', 'traitdb__id'))
+        moved, errors = 0, list()
+        for start in range(0, len(pairs), chunk_size):
+            chunk = dict(pairs[start:start + chunk_size])
+            found = Attribute.objects.in_bulk(list(chunk))
+            traits = cls.objects.select_related('db_trait_definition').in_bulk(set(chunk.values()))
+            updates = list()
+            for attr_id, trait_id in chunk.items():
+                trait = traits[trait_id]
+                bits = trait.db_marks
+                for mark in found[attr_id].value or ():
+                    try:
+                        bits |= trait.db_trait_definition.mark_bit(mark)
+                    except ValueError as err:
+                        errors.append(f"Trait {trait_id}: {err}")
+                if bits != trait.db_marks:
+                    trait.db_marks = bits
+                    updates.append(trait)
+            with transaction.atomic():
+                cls.objects.bulk_update(updates, ['db_marks'])
+                Attribute.objects.filter(id__in=list(chunk)).delete()
+            moved += len(updates)
+        return moved, errors
+
 
 class PoolDefinitionDB(TypedObject):
     __settingclasspath__ = "athanor_storyteller.traits.DefaultPoolDefinition"
     __defaultclasspath__ = "athanor_storyteller.traits.DefaultPoolDefinition"
     __applabel__ = "athanor_storyteller"
 
-    db_system = models.ForeignKey(StorySystem, related_name='trait_definitions', on_delete=models.PROTECT)
+    db_system = models.ForeignKey(StorySystem, related_name='pool_definitions', on_delete=models.PROTECT)
     db_system_identifier = models.CharField(max_length=255, null=True, blank=False)
 
+    # A Pool's maximum is db_maximum_base plus db_maximum_multiplier times the sum of the
+    # Persona's values for the comma-separated Trait system identifiers in db_maximum_traits.
+    db_maximum_base = models.IntegerField(default=0, null=False)
+    db_maximum_multiplier = models.IntegerField(default=1, null=False)
+    db_maximum_traits = models.CharField(max_length=255, null=False, blank=True, default='')
+
+    # Every db_regen_interval seconds, a Pool below its maximum regains db_regen_amount.
+    # Either being zero disables regeneration.
+    db_regen_amount = models.IntegerField(default=0, null=False)
+    db_regen_interval = models.PositiveIntegerField(default=0, null=False)
+
     class Meta:
         unique_together = (('db_system', 'db_system_identifier'), )
         verbose_name = 'PoolDefinition'
         verbose_name_plural = 'PoolDefinitions'
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if (system := StorySystem.get_cached_instance(self.db_system_id)):
+            system._pool_identifiers = None
+
 
 class PoolDB(TypedObject):
     __settingclasspath__ = "athanor_storyteller.traits.DefaultPool"
@@ -150,3 +376,58 @@ class PoolDB(TypedObject):
     db_persona = models.ForeignKey(PersonaDB, related_name='pools', on_delete=models.CASCADE)
     db_pool_definition = models.ForeignKey(PoolDefinitionDB, related_name='pools', on_delete=models.PROTECT)
     db_bonus_maximum = models.IntegerField(default=0, null=False, blank=False)
+    db_current_value = models.IntegerField(default=0, null=False, blank=False)
+
+    # The computed maximum (trait-derived plus db_bonus_maximum). Stored so regeneration can be
+    # capped inside a single UPDATE.
+    db_maximum = models.IntegerField(default=0, null=False, blank=False)
+
+    # When this Pool next regenerates. Null while it is full.
+    db_next_regen = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = (('db_persona', 'db_pool_definition'),)
+        indexes = [models.Index(fields=['db_pool_definition', 'db_next_regen'])]
+        verbose_name = 'Pool'
+        verbose_name_plural = 'Pools'
+
+
+class TraitJournalDB(models.Model):
+    """
+    Append-only history of sheet changes. Persona, Definition and enactor (Account) are
+    kept as bare ids instead of ForeignKeys so the history outlives what it describes.
+    """
+    KIND_VALUE = 0
+    KIND_DAMAGE = 1
+    KIND_TEMPLATE = 2
+    KIND_DELETE = 3
+
+    db_persona = models.IntegerField(null=False)
+    db_definition = models.IntegerField(null=True)
+    db_context = models.CharField(max_length=255, null=False, blank=True, default='')
+    db_old_value = models.BigIntegerField(null=True)
+    db_new_value = models.BigIntegerField(null=True)
+    db_kind = models.PositiveSmallIntegerField(default=KIND_VALUE, null=False)
+    db_enactor = models.IntegerField(null=True)
+    db_date_created = models.DateTimeField(null=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['db_persona', 'db_date_created'])]
+        verbose_name = 'TraitJournal'
+        verbose_name_plural = 'TraitJournals'
+
+
+class PersonaSnapshotDB(models.Model):
+    """
+    A full copy of a Persona's sheet at a moment, so rebuilding history only has to
+    replay the journal entries written after it. db_data is a JSON list of
+    [definition id, context, base value, damage value].
+    """
+    db_persona = models.IntegerField(null=False)
+    db_date_created = models.DateTimeField(null=False)
+    db_data = models.TextField(null=False, blank=True, default='[]')
+
+    class Meta:
+        indexes = [models.Index(fields=['db_persona', 'db_date_created'])]
+        verbose_name = 'PersonaSnapshot'
+        verbose_name_plural = 'PersonaSnapshots'
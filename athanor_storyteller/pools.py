@@ -0,0 +1,46 @@
+from datetime import timedelta
+
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Least
+
+from athanor.utils.time import utcnow
+
+from athanor_storyteller.buffers import WRITE_BEHIND
+from athanor_storyteller.models import PoolDefinitionDB, PoolDB
+
+
+def regenerate_pools():
+    """
+    Global regeneration tick for every Pool in the game.
+
+    Issues one UPDATE per regenerating PoolDefinition, covering every Pool of that
+    definition whose db_next_regen has passed, then applies the same arithmetic to
+    any of those Pools the idmapper is holding so cached instances stay correct.
+    """
+    WRITE_BEHIND.flush()
+    now = utcnow()
+    definitions = {pool_def.id: pool_def for pool_def in
+                   PoolDefinitionDB.objects.filter(db_regen_amount__gt=0, db_regen_interval__gt=0)}
+    for pool_def in definitions.values():
+        amount = pool_def.db_regen_amount
+        next_regen = now + timedelta(seconds=pool_def.db_regen_interval)
+        # db_next_regen comes first because MySQL evaluates SET clauses left to right.
+        PoolDB.objects.filter(db_pool_definition=pool_def, db_next_regen__lte=now).update(
+            db_next_regen=Case(When(db_current_value__lt=F('db_maximum') - amount, then=Value(next_regen)),
+                               default=Value(None)),
+            db_current_value=Case(When(db_current_value__lt=F('db_maximum'),
+                                       then=Least(F('db_current_value') + amount, F('db_maximum'))),
+                                  default=F('db_current_value')))
+
+    for pool in PoolDB.get_all_cached_instances():
+        if not (pool_def := definitions.get(pool.db_pool_definition_id, None)):
+            continue
+        if not pool.db_next_regen or pool.db_next_regen > now:
+            continue
+        amount = pool_def.db_regen_amount
+        if pool.db_current_value < pool.db_maximum - amount:
+            pool.db_next_regen = now + timedelta(seconds=pool_def.db_regen_interval)
+        else:
+            pool.db_next_regen = None
+        if pool.db_current_value < pool.db_maximum:
+            pool.db_current_value = min(pool.db_current_value + amount, pool.db_maximum)
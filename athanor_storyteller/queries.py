@@ -0,0 +1,97 @@
+import re
+
+from django.db.models import Q
+
+from athanor_storyteller.buffers import WRITE_BEHIND
+from athanor_storyteller.models import TraitDB
+
+_CRITERION = re.compile(r"^(?P<trait>.+?)\s*(?P<op>>=|<=|!=|=|>|<)\s*(?P<value>-?\d+)$")
+
+_LOOKUPS = {
+    '>=': 'gte',
+    '<=': 'lte',
+    '>': 'gt',
+    '<': 'lt',
+    '=': 'exact',
+}
+
+
+class TraitQuery(object):
+    """
+    Finds every Persona in a StorySystem whose Traits meet all of a set of criteria,
+    such as 'Occult>=4' or 'Melee: Swords'. A criterion without a comparison means
+    'has the Trait at all'; a context of * matches any context.
+
+    Each criterion compiles to a filter on (db_trait_definition, db_icontext,
+    db_base_value), which the composite indexes on TraitDB answer directly. The first
+    criterion drives the result rows; the others narrow the Personas by subquery.
+    Results are read as plain tuples, a page at a time, keyed on Trait id, so no
+    typeclassed model is ever instantiated.
+    """
+    fields = ('id', 'db_persona_id', 'db_persona__db_key', 'db_persona__db_object__db_key',
+              'db_context', 'db_base_value')
+
+    def __init__(self, system, criteria, parse):
+        """
+        Args:
+            system (StorySystem): The system to search.
+            criteria (iterable of str): Criteria, all of which must match.
+            parse (callable): Resolves a trait string to (TraitDefinition, context);
+                usually AthanorPersonaController.parse_trait.
+        """
+        self.system = system
+        self.filters = list()
+        errors = list()
+        for criterion in criteria:
+            try:
+                self.filters.append(self.compile(criterion, parse))
+            except ValueError as err:
+                errors.append(str(err))
+        if errors:
+            raise ValueError('\n'.join(errors))
+        if not self.filters:
+            raise ValueError("Nothing entered to search for!")
+
+    def compile(self, criterion, parse):
+        if (match := _CRITERION.match(criterion.strip())):
+            trait, op, value = match.group('trait'), match.group('op'), int(match.group('value'))
+        else:
+            trait, op, value = criterion, None, None
+        definition, context = parse(self.system, trait)
+        found = Q(db_trait_definition_id=definition.id)
+        if context != '*':
+            found &= Q(db_icontext=context.lower())
+        if op is None:
+            return found
+        if op == '!=':
+            return found & ~Q(db_base_value=value)
+        return found & Q(**{f"db_base_value__{_LOOKUPS[op]}": value})
+
+    def queryset(self):
+        first, *rest = self.filters
+        queryset = TraitDB.objects.filter(first)
+        for other in rest:
+            queryset = queryset.filter(db_persona_id__in=TraitDB.objects.filter(other).values('db_persona_id'))
+        return queryset
+
+    def count(self):
+        WRITE_BEHIND.flush()
+        return self.queryset().values('db_persona_id').distinct().count()
+
+    def pages(self, size=100):
+        """
+        Yields lists of named rows (id, db_persona_id, db_persona__db_key,
+        db_persona__db_object__db_key, db_context, db_base_value), at most size each.
+        """
+        WRITE_BEHIND.flush()
+        queryset = self.queryset().order_by('id').values_list(*self.fields, named=True)
+        last = 0
+        while (page := list(queryset.filter(id__gt=last)[:size])):
+            yield page
+            last = page[-1].id
+            if len(page) < size:
+                break
+
+    def __iter__(self):
+        for page in self.pages():
+            yield from page
@@ -0,0 +1,79 @@
+from django.conf import settings
+from evennia.utils.utils import class_from_module
+
+
+class TypeclassRegistry(object):
+    """
+    Remembers which typeclass a TraitDefinition hands to its Traits and to its new
+    child Definitions, keyed by definition id. Inherited typeclasses are resolved once;
+    a Definition whose answer came from a parent is recorded as that parent's dependent
+    so changing the parent invalidates the whole affected branch.
+    """
+
+    def __init__(self):
+        self.classes = dict()
+        self.traits = dict()
+        self.children = dict()
+        self.dependents = dict()
+        self.default_trait = None
+        self.default_definition = None
+
+    def register(self, path, typeclass):
+        """
+        Seed the path cache with a class that has already been imported elsewhere.
+        """
+        if path and typeclass:
+            self.classes[path] = typeclass
+
+    def load_class(self, path):
+        if not (found := self.classes.get(path, None)):
+            found = class_from_module(path, defaultpaths=settings.TYPECLASS_PATHS)
+            self.classes[path] = found
+        return found
+
+    def get_default_trait(self):
+        if not self.default_trait:
+            from athanor_storyteller.gamedb import DefaultTrait
+            self.default_trait = DefaultTrait
+        return self.default_trait
+
+    def get_default_definition(self):
+        if not self.default_definition:
+            from athanor_storyteller.gamedb import DefaultTraitDefinition
+            self.default_definition = DefaultTraitDefinition
+        return self.default_definition
+
+    def _resolve(self, definition, cache, field, default):
+        if definition.id and (found := cache.get(definition.id, None)):
+            return found
+        if (path := getattr(definition, field)):
+            found = self.load_class(path)
+        elif (parent := definition.db_parent):
+            found = self._resolve(parent, cache, field, default)
+            if definition.id:
+                self.dependents.setdefault(parent.id, set()).add(definition.id)
+        else:
+            found = default()
+        if definition.id:
+            cache[definition.id] = found
+        return found
+
+    def trait_typeclass(self, definition):
+        return self._resolve(definition, self.traits, 'db_trait_default_typeclass', self.get_default_trait)
+
+    def child_typeclass(self, definition):
+        return self._resolve(definition, self.children, 'db_child_default_typeclass', self.get_default_definition)
+
+    def invalidate(self, def_id):
+        self.traits.pop(def_id, None)
+        self.children.pop(def_id, None)
+        for dependent in self.dependents.pop(def_id, set()):
+            self.invalidate(dependent)
+
+    def clear(self):
+        self.traits.clear()
+        self.children.clear()
+        self.dependents.clear()
+
+
+TYPECLASSES = TypeclassRegistry()
@@ -0,0 +1,76 @@
+import json
+import mmap
+import os
+
+from django.conf import settings
+from django.db.models import Count, Max
+from evennia.utils.logger import log_trace
+
+# Bump whenever the row layout in indexes.DefinitionEntry.fields changes.
+SNAPSHOT_VERSION = 2
+
+
+class DefinitionSnapshot(object):
+    """
+    On-disk copy of one StorySystem's TraitDefinition rows, so a warm start can build
+    the definition index without reading the whole table.
+
+    A snapshot file is two lines of JSON: a small header (format version, system id
+    and checksum) and then the rows. Only the header is read to decide freshness; the
+    rows are parsed straight out of a memory map. The checksum is the system's
+    db_revision, which every definition change bumps, plus the row count and highest
+    id, so rows written behind the ORM's back also make the snapshot stale.
+
+    Snapshots live in settings.STORYTELLER_SNAPSHOT_DIR (server/storyteller under the
+    game dir by default). Setting it to None disables them.
+    """
+
+    def __init__(self, system):
+        self.system = system
+
+    @property
+    def directory(self):
+        default = os.path.join(settings.GAME_DIR, 'server', 'storyteller')
+        return getattr(settings, 'STORYTELLER_SNAPSHOT_DIR', default)
+
+    @property
+    def path(self):
+        if not (directory := self.directory):
+            return None
+        return os.path.join(directory, f"definitions_{self.system.id}.json")
+
+    def checksum(self):
+        found = self.system.trait_definitions.aggregate(count=Count('id'), last=Max('id'))
+        return [self.system.db_revision, found['count'], found['last'] or 0]
+
+    def header(self, checksum):
+        return {'version': SNAPSHOT_VERSION, 'system': self.system.id, 'checksum': checksum}
+
+    def read(self, checksum):
+        """
+        Returns the stored rows if the snapshot matches checksum, otherwise None.
+        """
+        if not (path := self.path) or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if json.loads(data.readline()) != self.header(checksum):
+                    return None
+                return json.loads(data[data.tell():])
+        except Exception:
+            log_trace()
+            return None
+
+    def write(self, checksum, rows):
+        if not (path := self.path):
+            return
+        temp = f"{path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp, 'w') as f:
+                f.write(json.dumps(self.header(checksum)))
+                f.write('\n')
+                json.dump(rows, f, separators=(',', ':'))
+            os.replace(temp, path)
+        except Exception:
+            log_trace()
@@ -0,0 +1,246 @@
+"""
+Streaming export and import of Persona sheets as JSON Lines, one Persona per line:
+
+    {"system": "Exalted", "object": {"id": 42, "key": "Bob"}, "key": "Dawn Caste",
+     "typeclass": "typeclasses.personas.Solar",
+     "traits": [["attribute_strength", "", 3, 0, []], ["Abilities/Melee", "Swords", 2, 0, ["favored"]]],
+     "pools": [["essence_personal", 12, 0, 16]]}
+
+A trait names its Definition by system identifier when it has one and by fullpath
+otherwise, followed by context, base value, damage and marks. A pool names its
+PoolDefinition by system identifier, followed by current value, bonus maximum and
+maximum.
+"""
+import json
+from datetime import timedelta
+
+from django.db import transaction
+
+from athanor.utils.time import utcnow
+
+from athanor_storyteller.buffers import WRITE_BEHIND
+from athanor_storyteller.models import StorySystem, PersonaDB, TraitDB, PoolDB, PoolDefinitionDB
+from athanor_storyteller.registry import TYPECLASSES
+
+
+def _definition_class(entry):
+    return TYPECLASSES.load_class(entry.typeclass_path) if entry.typeclass_path else TYPECLASSES.get_default_definition()
+
+
+class PersonaExporter(object):
+    """
+    Writes Personas a chunk at a time, keyed on id, using only values queries, so memory
+    stays flat however many Personas there are.
+    """
+
+    def __init__(self, systems=None, chunk_size=500):
+        self.systems = systems
+        self.chunk_size = chunk_size
+        self.count = 0
+
+    def records(self):
+        WRITE_BEHIND.flush()
+        personas = PersonaDB.objects.order_by('id')
+        if self.systems:
+            personas = personas.filter(db_system__in=self.systems)
+        personas = personas.values_list('id', 'db_key', 'db_typeclass_path', 'db_object_id', 'db_object__db_key',
+                                        'db_system_id')
+        systems = dict()
+        pool_names = dict(PoolDefinitionDB.objects.values_list('id', 'db_system_identifier'))
+        last = 0
+        while (chunk := list(personas.filter(id__gt=last)[:self.chunk_size])):
+            last = chunk[-1][0]
+            ids = [row[0] for row in chunk]
+            traits, pools = dict(), dict()
+            for persona_id, def_id, context, base, damage, marks in TraitDB.objects.filter(
+                    db_persona_id__in=ids).order_by('id').values_list(
+                    'db_persona_id', 'db_trait_definition_id', 'db_context', 'db_base_value', 'db_damage_value',
+                    'db_marks'):
+                traits.setdefault(persona_id, list()).append((def_id, context, base, damage, marks))
+            for row in PoolDB.objects.filter(db_persona_id__in=ids).values_list(
+                    'db_persona_id', 'db_pool_definition_id', 'db_current_value', 'db_bonus_maximum', 'db_maximum'):
+                pools.setdefault(row[0], list()).append(row[1:])
+
+            for persona_id, key, typeclass, obj_id, obj_key, system_id in chunk:
+                if (system := systems.get(system_id, None)) is None:
+                    system = StorySystem.objects.get(id=system_id)
+                    systems[system_id] = system
+                index = system.definitions
+                sheet = list()
+                for def_id, context, base, damage, marks in traits.get(persona_id, list()):
+                    entry = index.get(def_id)
+                    can_mark = _definition_class(entry).can_mark if marks else list()
+                    sheet.append([entry.system_identifier or index.fullpath(entry), context, base, damage,
+                                  [mark for position, mark in enumerate(can_mark) if marks & (1 << position)]])
+                yield {'system': system.db_key, 'object': {'id': obj_id, 'key': obj_key}, 'key': key,
+                       'typeclass': typeclass, 'traits': sheet,
+                       'pools': [[pool_names[pool_def_id], current, bonus, maximum]
+                                 for pool_def_id, current, bonus, maximum in pools.get(persona_id, list())]}
+
+    def write(self, stream):
+        for record in self.records():
+            stream.write(json.dumps(record, separators=(',', ':')))
+            stream.write('\n')
+            self.count += 1
+        return self.count
+
+
+class PersonaImporter(object):
+    """
+    Reads Persona records a batch at a time and bulk-inserts each batch's Personas,
+    Traits and Pools inside one transaction. Definitions are resolved through each
+    StorySystem's cached definition index and objects by id (when the key still
+    matches) or else by a key only one object has. Personas that already exist are
+    skipped, as are traits and pools whose definitions can't be found; every problem
+    is collected in errors.
+    """
+
+    def __init__(self, batch_size=500):
+        self.batch_size = batch_size
+        self.systems = dict()
+        self.pool_definitions = dict()
+        self.trait_classes = dict()
+        self.stats = {'personas': 0, 'traits': 0, 'pools': 0, 'skipped': 0}
+        self.errors = list()
+
+    def read(self, stream):
+        for number, line in enumerate(stream, 1):
+            if (line := line.strip()):
+                record = json.loads(line)
+                record['_line'] = number
+                yield record
+
+    def run(self, records):
+        batch = list()
+        for record in records:
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch)
+                batch = list()
+        if batch:
+            self.import_batch(batch)
+        return dict(self.stats)
+
+    def get_system(self, key):
+        if (found := self.systems.get(key, None)) is None:
+            if not (found := StorySystem.objects.filter(db_key__iexact=key).first()):
+                raise ValueError(f"Story System '{key}' not found!")
+            self.systems[key] = found
+            self.pool_definitions[found.id] = {pool_def.db_system_identifier: pool_def
+                                               for pool_def in found.pool_definitions.all()}
+        return found
+
+    def trait_class(self, system, entry):
+        if (found := self.trait_classes.get(entry.id, None)) is None:
+            found = TYPECLASSES.trait_typeclass(system.definitions.get_definition(entry))
+            self.trait_classes[entry.id] = found
+        return found
+
+    def resolve_objects(self, batch):
+        from evennia.objects.models import ObjectDB
+        ids = {record['object']['id'] for record in batch if record['object'].get('id', None)}
+        by_id = dict(ObjectDB.objects.filter(id__in=ids).values_list('id', 'db_key'))
+        keys = {record['object']['key'] for record in batch}
+        by_key = dict()
+        for obj_id, key in ObjectDB.objects.filter(db_key__in=keys).values_list('id', 'db_key'):
+            by_key.setdefault(key, list()).append(obj_id)
+        found = dict()
+        for record in batch:
+            obj = record['object']
+            if by_id.get(obj.get('id', None), None) == obj['key']:
+                found[record['_line']] = obj['id']
+            elif len(matches := by_key.get(obj['key'], list())) > 1:
+                # Several objects share the key; guessing would hand the sheet to the wrong one.
+                found[record['_line']] = None
+            elif matches:
+                found[record['_line']] = matches[0]
+        return found
+
+    def import_batch(self, batch):
+        objects = self.resolve_objects(batch)
+        wanted = list()
+        for record in batch:
+            try:
+                system = self.get_system(record['system'])
+            except ValueError as err:
+                self.errors.append(f"Line {record['_line']}: {err}")
+                self.stats['skipped'] += 1
+                continue
+            if (obj_id := objects.get(record['_line'], 0)) is None:
+                self.errors.append(f"Line {record['_line']}: object {record['object']['key']} is ambiguous; "
+                                   f"several objects have that key.")
+                self.stats['skipped'] += 1
+                continue
+            if not obj_id:
+                self.errors.append(f"Line {record['_line']}: object {record['object']['key']} not found.")
+                self.stats['skipped'] += 1
+                continue
+            wanted.append((record, system, obj_id))
+        existing = set(PersonaDB.objects.filter(db_object_id__in={obj_id for record, system, obj_id in wanted})
+                       .values_list('db_object_id', 'db_system_id', 'db_ikey'))
+
+        personas = list()
+        for record, system, obj_id in wanted:
+            if (key := (obj_id, system.id, record['key'].lower())) in existing:
+                self.errors.append(f"Line {record['_line']}: {record['object']['key']} already has Persona {record['key']}.")
+                self.stats['skipped'] += 1
+                continue
+            try:
+                typeclass = TYPECLASSES.load_class(record['typeclass'])
+            except Exception as err:
+                self.errors.append(f"Line {record['_line']}: cannot load typeclass {record['typeclass']}: {err}")
+                self.stats['skipped'] += 1
+                continue
+            existing.add(key)
+            personas.append((record, system, typeclass(db_key=record['key'], db_ikey=record['key'].lower(),
+                                                       db_object_id=obj_id, db_system=system)))
+        if not personas:
+            return
+
+        with transaction.atomic():
+            PersonaDB.objects.bulk_create([persona for record, system, persona in personas], batch_size=self.batch_size)
+            if any(persona.pk is None for record, system, persona in personas):
+                # Backends that don't return primary keys from bulk_create need a re-read.
+                ids = {row[1:]: row[0] for row in PersonaDB.objects.filter(
+                    db_object_id__in={persona.db_object_id for record, system, persona in personas}).values_list(
+                    'id', 'db_object_id', 'db_system_id', 'db_ikey')}
+                for record, system, persona in personas:
+                    persona.id = ids[(persona.db_object_id, system.id, persona.db_ikey)]
+            traits, pools = list(), list()
+            now = utcnow()
+            for record, system, persona in personas:
+                traits.extend(self.build_traits(record, system, persona))
+                pools.extend(self.build_pools(record, system, persona, now))
+            TraitDB.objects.bulk_create(traits, batch_size=self.batch_size)
+            PoolDB.objects.bulk_create(pools, batch_size=self.batch_size)
+        self.stats['personas'] += len(personas)
+        self.stats['traits'] += len(traits)
+        self.stats['pools'] += len(pools)
+
+    def build_traits(self, record, system, persona):
+        index = system.definitions
+        for ref, context, base, damage, marks in record.get('traits', list()):
+            if not (entry := index.by_identifier(ref) or index.find_path(ref)):
+                self.errors.append(f"Line {record['_line']}: unknown trait {ref} for {record['key']}.")
+                continue
+            bits = 0
+            for mark in marks:
+                try:
+                    bits |= _definition_class(entry).mark_bit(mark)
+                except ValueError as err:
+                    self.errors.append(f"Line {record['_line']}: {err}")
+            yield self.trait_class(system, entry)(db_persona=persona, db_trait_definition_id=entry.id,
+                                                  db_context=context, db_icontext=context.lower(),
+                                                  db_base_value=base, db_damage_value=damage, db_marks=bits)
+
+    def build_pools(self, record, system, persona, now):
+        from athanor_storyteller.gamedb import DefaultPool
+        definitions = self.pool_definitions[system.id]
+        for ref, current, bonus, maximum in record.get('pools', list()):
+            if not (pool_def := definitions.get(ref, None)):
+                self.errors.append(f"Line {record['_line']}: unknown pool {ref} for {record['key']}.")
+                continue
+            next_regen = now + timedelta(seconds=pool_def.db_regen_interval) if \
+                current < maximum and pool_def.regenerates else None
+            yield DefaultPool(db_persona=persona, db_pool_definition=pool_def, db_current_value=current,
+                              db_bonus_maximum=bonus, db_maximum=maximum, db_next_regen=next_regen)
@@ -0,0 +1,55 @@
+"""
+Compares the vectorized DiceRoller against a naive per-die random.randint loop.
+
+    python benchmarks/bench_dice.py [--rolls 500] [--pool 8] [--repeat 5]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from athanor_storyteller.dice import DiceRoller, probability_table
+
+
+def naive_roll(pool, target=7, double=10):
+    successes = 0
+    ones = 0
+    for _ in range(pool):
+        die = random.randint(1, 10)
+        if die >= target:
+            successes += 1
+        if double and die >= double:
+            successes += 1
+        if die == 1:
+            ones += 1
+    return successes, successes == 0 and ones > 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rolls', type=int, default=500)
+    parser.add_argument('--pool', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    roller = DiceRoller()
+    pools = [args.pool] * args.rolls
+
+    naive = min(timeit.repeat(lambda: [naive_roll(p) for p in pools], number=1, repeat=args.repeat))
+    vector = min(timeit.repeat(lambda: roller.roll_many(pools), number=1, repeat=args.repeat))
+    print(f"{args.rolls} rolls of {args.pool} dice")
+    print(f"  naive randint loop: {naive * 1000:9.3f} ms")
+    print(f"  DiceRoller batch:   {vector * 1000:9.3f} ms  ({naive / vector:.1f}x)")
+
+    probability_table.cache_clear()
+    cold = timeit.timeit(lambda: roller.odds(args.pool, 3), number=1)
+    warm = min(timeit.repeat(lambda: roller.odds(args.pool, 3), number=1000, repeat=args.repeat)) / 1000
+    print(f"odds({args.pool}, 3) = {roller.odds(args.pool, 3):.4f}")
+    print(f"  table build: {cold * 1000:9.3f} ms, cached lookup: {warm * 1e6:9.3f} us")
+
+
+if __name__ == '__main__':
+    main()
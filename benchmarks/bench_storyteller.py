@@ -0,0 +1,170 @@
+"""
+Latency and query counts of the storyteller hot paths at several data sizes, against an
+in-memory SQLite database. Needs Evennia and Athanor installed.
+
+    python benchmarks/bench_storyteller.py [--sizes small,medium] [--repeat 200]
+        [--output results.json] [--compare previous.json]
+
+Each size gets its own synthetic game line (see generator.py) and set of Personas.
+Results are written as JSON; --compare prints each path's change against an earlier run.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django
+
+django.setup()
+
+from django.apps import apps
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from evennia.utils.create import create_object
+
+from athanor_storyteller.controllers import AthanorPersonaController
+from athanor_storyteller.gamedb import DefaultPersona
+from athanor_storyteller.importer import DefinitionImporter
+from athanor_storyteller.indexes import PersonaDirectory
+from athanor_storyteller.models import StorySystem, TraitDB, TraitDefinitionDB
+
+from benchmarks.generator import GameLine
+
+# name: (depth, fanout, personas, traits per persona)
+SIZES = {
+    'small': (3, 6, 20, 40),
+    'medium': (3, 12, 100, 60),
+    'large': (4, 9, 300, 80),
+}
+
+
+def create_tables():
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    # The storyteller app has a migrations package but no migrations yet, so migrate skips it.
+    with connection.schema_editor() as editor:
+        for model in apps.get_app_config('athanor_storyteller').get_models():
+            if model._meta.db_table not in connection.introspection.table_names():
+                editor.create_model(model)
+
+
+def measure(func, calls):
+    """
+    Calls func(i) for i in range(calls). Returns latency percentiles and queries per call.
+    """
+    times = list()
+    with CaptureQueriesContext(connection) as queries:
+        for i in range(calls):
+            start = time.perf_counter()
+            func(i)
+            times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {'calls': calls, 'mean_ms': statistics.mean(times), 'p50_ms': times[len(times) // 2],
+            'p95_ms': times[int(len(times) * 0.95)], 'max_ms': times[-1], 'queries': len(queries) / calls}
+
+
+def run_size(name, repeat):
+    depth, fanout, persona_count, trait_count = SIZES[name]
+    line = GameLine(depth=depth, fanout=fanout, seed=len(name))
+    system = StorySystem.objects.create(db_key=f"bench_{name}")
+    importer = DefinitionImporter(system)
+    start = time.perf_counter()
+    importer.run(importer.flatten(line.make_tree()))
+    results = [{'path': 'import_definitions', 'calls': 1, 'mean_ms': (time.perf_counter() - start) * 1000}]
+
+    # The controller's manager isn't running here; these paths only need its directory.
+    controller = AthanorPersonaController.__new__(AthanorPersonaController)
+    controller.directory = PersonaDirectory()
+    characters = [create_object('evennia.objects.objects.DefaultObject', key=f"{name}_char{i}", nohome=True)
+                  for i in range(persona_count)]
+
+    personas = list()
+    results.append(dict(measure(lambda i: personas.append(
+        DefaultPersona.create(characters[i], system, f"Persona {i}")), persona_count), path='create_persona'))
+
+    sheets = list()
+    for persona in personas:
+        sheet = line.sheet(trait_count)
+        entries = [(*controller.parse_trait(system, path), value) for path, value in sheet]
+        persona.set_trait_values(entries)
+        sheets.append(sheet)
+
+    paths = [path for sheet in sheets for path, value in sheet]
+    leaves = [path.rsplit('/', 1)[1] for path in paths]
+    system.definitions.invalidate()
+    results.append(dict(measure(lambda i: controller.parse_trait(system, paths[i % len(paths)]), 1), path='parse_trait_cold'))
+    results.append(dict(measure(lambda i: controller.parse_trait(system, paths[i % len(paths)]), repeat),
+                        path='parse_trait_fullpath'))
+
+    def quick(i):
+        try:
+            controller.parse_trait(system, leaves[i % len(leaves)])
+        except ValueError:
+            pass
+    results.append(dict(measure(quick, repeat), path='parse_trait_quickfind'))
+
+    definitions = list(TraitDefinitionDB.objects.filter(db_system=system, db_depth=depth - 1)[:repeat])
+    results.append(dict(measure(lambda i: definitions[i % len(definitions)].fullpath(), repeat), path='definition_fullpath'))
+    results.append(dict(measure(lambda i: TraitDB.bulk_fullpaths(personas[i % len(personas)].traits.all()),
+                                min(repeat, len(personas))), path='trait_bulk_fullpaths'))
+
+    targets = [controller.parse_trait(system, path)[0] for path, value in sheets[0]]
+    results.append(dict(measure(lambda i: personas[0].set_trait_value(targets[i % len(targets)], '', i % 5 + 1),
+                                repeat), path='set_trait_value'))
+    batch = [(trait, '', 3) for trait in targets]
+    results.append(dict(measure(lambda i: personas[i % len(personas)].set_trait_values(batch),
+                                min(repeat, len(personas))), path='set_trait_values_batch'))
+
+    for result in results:
+        result.update(size=name, definitions=importer.stats['created'], personas=persona_count,
+                      traits_per_persona=trait_count)
+    return results
+
+
+def compare(results, previous):
+    old = {(row['size'], row['path']): row for row in previous['results']}
+    print(f"{'size':8} {'path':26} {'mean ms':>10} {'was':>10} {'change':>8} {'queries':>8} {'was':>8}")
+    for row in results:
+        if not (before := old.get((row['size'], row['path']), None)):
+            continue
+        change = (row['mean_ms'] / before['mean_ms'] - 1) * 100 if before['mean_ms'] else 0.0
+        print(f"{row['size']:8} {row['path']:26} {row['mean_ms']:10.3f} {before['mean_ms']:10.3f} {change:+7.1f}% "
+              f"{row.get('queries', 0):8.1f} {before.get('queries', 0):8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='small,medium')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--compare', default=None)
+    args = parser.parse_args()
+
+    create_tables()
+    results = list()
+    for name in args.sizes.split(','):
+        if name not in SIZES:
+            raise SystemExit(f"Unknown size {name}; choose from {', '.join(SIZES)}")
+        results.extend(run_size(name, args.repeat))
+
+    for row in results:
+        print(f"{row['size']:8} {row['path']:26} {row['mean_ms']:10.3f} ms  {row.get('queries', 0):6.1f} queries")
+    report = {'meta': {'time': time.time(), 'python': platform.python_version(), 'sizes': args.sizes,
+                       'repeat': args.repeat}, 'results': results}
+    output = args.output or f"bench_storyteller_{int(report['meta']['time'])}.json"
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
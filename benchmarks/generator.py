@@ -0,0 +1,74 @@
+"""
+Synthetic game lines for the benchmarks.
+
+make_tree() builds a TraitDefinition tree shaped like a Storyteller game line: a few
+top-level categories fanning out into leaf Traits that can be bought and rolled, some
+of which take contexts. Names are built from syllables so quick-find searches have
+realistic prefix and substring collisions. Everything is derived from a seed, so the
+same arguments always produce the same data.
+"""
+import random
+
+SYLLABLES = ('ar', 'bel', 'cor', 'dra', 'el', 'fen', 'gal', 'hes', 'is', 'jor', 'ka', 'lum', 'mor', 'nel',
+             'or', 'pra', 'quel', 'ris', 'sar', 'tor', 'ul', 'ven', 'wyr', 'xa', 'yel', 'zor')
+
+
+class GameLine(object):
+    """
+    Args:
+        depth (int): Levels of Definitions, counting the top-level categories.
+        fanout (int): Children of every non-leaf Definition.
+        seed (int): Seed for names and values.
+    """
+
+    def __init__(self, depth=3, fanout=8, seed=0):
+        self.depth = depth
+        self.fanout = fanout
+        self.rng = random.Random(seed)
+        self.leaves = list()
+        self.count = 0
+
+    def name(self, taken):
+        while True:
+            found = ''.join(self.rng.choice(SYLLABLES) for _ in range(self.rng.randint(2, 4))).title()
+            if found not in taken:
+                taken.add(found)
+                return found
+
+    def node(self, level, path):
+        taken = set()
+        nodes = list()
+        for _ in range(self.fanout):
+            key = self.name(taken)
+            full = f"{path}/{key}" if path else key
+            self.count += 1
+            node = {'key': key}
+            if level + 1 < self.depth:
+                node['allow_buy'] = False
+                node['children'] = self.node(level + 1, full)
+            else:
+                node['identifier'] = f"t{self.count}"
+                node['can_roll'] = True
+                node['allow_context'] = self.rng.random() < 0.1
+                if self.rng.random() < 0.2:
+                    node['bonuses'] = {f"t{self.rng.randint(1, self.count)}": 1}
+                self.leaves.append(full)
+            nodes.append(node)
+        return nodes
+
+    def make_tree(self):
+        """
+        Returns the tree as DefinitionImporter.flatten() input.
+        """
+        self.leaves = list()
+        self.count = 0
+        tree = self.node(0, '')
+        # The first category carries the cost rule the rest of the tree inherits.
+        tree[0]['cost_rule'] = {'first': 3, 'multiplier': 2}
+        return tree
+
+    def sheet(self, traits=60):
+        """
+        Returns (leaf fullpath, value) pairs for one Persona.
+        """
+        return [(path, self.rng.randint(1, 5)) for path in self.rng.sample(self.leaves, min(traits, len(self.leaves)))]
@@ -0,0 +1,19 @@
+"""
+Django settings for the storyteller benchmarks: Evennia's defaults on an in-memory
+SQLite database, with snapshots, write-behind and instrumentation left off so every
+run measures the plain database paths.
+"""
+from evennia.settings_default import *  # noqa
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+
+INSTALLED_APPS = list(INSTALLED_APPS) + ['athanor', 'athanor_storyteller']
+
+STORYTELLER_SNAPSHOT_DIR = None
+STORYTELLER_WRITE_BEHIND = False
+STORYTELLER_INSTRUMENT = False
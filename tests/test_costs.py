@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from athanor_storyteller.costs import CostTable, dot_costs
+
+
+class Index(object):
+
+    def __init__(self, *entries):
+        self.entries = {entry.id: entry for entry in entries}
+
+    def get(self, def_id):
+        return self.entries.get(def_id, None)
+
+
+def entry(def_id, parent_id=None, cost_rule=None):
+    return SimpleNamespace(id=def_id, parent_id=parent_id, cost_rule=cost_rule)
+
+
+def test_dot_costs_first_and_current_base():
+    assert dot_costs({'first': 3, 'multiplier': 2}, 6).tolist() == [0, 3, 2, 4, 6, 8]
+
+
+def test_dot_costs_table_then_new_base():
+    costs = dot_costs({'table': [1, 2, 3], 'multiplier': 4, 'base': 'new'}, 6)
+    assert np.cumsum(costs).tolist() == [0, 1, 3, 6, 22, 42]
+
+
+def test_dot_costs_flat():
+    assert dot_costs({'flat': 5}, 4).tolist() == [0, 5, 5, 5]
+
+
+def test_total_inherits_and_overrides():
+    index = Index(entry(1, cost_rule={'multiplier': 2}), entry(2, parent_id=1), entry(3))
+    table = CostTable(index, {2: {'flat': 1}})
+    assert table.total([1, 2, 3], [3, 4, 5]).tolist() == [6, 4, 0]
+    # The inherited rule applies when there's no override.
+    assert CostTable(index, dict()).total([2], [3]).tolist() == [6]
+
+
+def test_total_grows_width():
+    table = CostTable(Index(entry(1, cost_rule={'multiplier': 2})), dict())
+    assert table.total([1, 1, 99], [3, 12, 5]).tolist() == [6, 132, 0]
+    assert table.width == 13
+    assert table.total([], []).tolist() == []
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from athanor_storyteller.dice import DiceRoller, probability_table
+
+
+def binomial_at_least(n, k, p):
+    from math import comb
+    return sum(comb(n, i) * p ** i * (1 - p) ** (n - i) for i in range(k, n + 1))
+
+
+@pytest.mark.parametrize('pool', [1, 3, 8])
+def test_plain_odds_match_binomial(pool):
+    roller = DiceRoller(target=7, double=None)
+    for successes in range(pool + 1):
+        assert roller.odds(pool, successes) == pytest.approx(binomial_at_least(pool, successes, 0.4))
+
+
+@pytest.mark.parametrize('pool', [1, 4, 10])
+def test_botch_odds_closed_form(pool):
+    # No successes (faces 1-6) minus no successes and no 1s (faces 2-6).
+    assert DiceRoller(target=7).botch_odds(pool) == pytest.approx(0.6 ** pool - 0.5 ** pool)
+    assert DiceRoller(target=7, botch=False).botch_odds(pool) == 0.0
+
+
+@pytest.mark.parametrize('rules', [
+    dict(target=7, double=10),
+    dict(target=8, double=None, explode=(10,)),
+    dict(target=7, double=10, reroll=(1,)),
+])
+def test_table_matches_simulation(rules):
+    roller = DiceRoller(rng=np.random.default_rng(1234), **rules)
+    pool, rolls = 6, 100000
+    successes, botches, dice = roller.roll_many([pool] * rolls)
+    for needed in range(1, 6):
+        assert (successes >= needed).mean() == pytest.approx(roller.odds(pool, needed), abs=0.01)
+    assert botches.mean() == pytest.approx(roller.botch_odds(pool), abs=0.005)
+
+
+def test_negative_pool_rolls_nothing():
+    roller = DiceRoller(target=7)
+    assert roller.odds(-1, 1) == 0.0
+    assert roller.odds(-3, 0) == 1.0
+    assert roller.botch_odds(-2) == 0.0
+
+
+def test_large_pools_keep_the_whole_distribution():
+    roller = DiceRoller(target=7, double=10)
+    # 60 dice can score up to 120 successes; each one needs a 10 (double) to reach it.
+    assert roller.odds(60, 120) == pytest.approx(0.1 ** 60)
+    at_least, botch = roller.table(60)
+    assert at_least.shape[1] > 120 and at_least[60, 121] == 0.0
+
+
+def test_table_rows_are_monotonic_and_readonly():
+    at_least, botch = probability_table(7, 10, (), (10,), 30)
+    assert np.allclose(at_least[:, 0], 1.0)
+    assert (np.diff(at_least, axis=1) <= 1e-12).all()
+    assert not at_least.flags.writeable and not botch.flags.writeable
+
+
+def test_roll_many_pads_unused_dice():
+    successes, botches, dice = DiceRoller(rng=np.random.default_rng(5)).roll_many([0, 2, 5])
+    assert dice.shape == (3, 5)
+    assert (dice[0] == 0).all() and (dice[1, 2:] == 0).all()
+    assert ((dice[2] >= 1) & (dice[2] <= 10)).all()
+    assert successes[0] == 0 and not botches[0]
@@ -0,0 +1,69 @@
+import pytest
+
+from athanor_storyteller.indexes import TraitDefinitionIndex
+
+ROWS = [
+    (1, 'Attributes', None, None, 'Attributes', 0),
+    (2, 'Abilities', None, None, 'Abilities', 0),
+    (3, 'Strength', 1, 'attribute_strength', 'Attributes/Strength', 1),
+    (4, 'Stamina', 1, 'attribute_stamina', 'Attributes/Stamina', 1),
+    (5, 'Melee', 2, 'ability_melee', 'Abilities/Melee', 1),
+    (6, 'Martial Arts', 2, None, 'Abilities/Martial Arts', 1),
+    (7, 'Art', 2, None, 'Abilities/Art', 1),
+]
+
+
+class Index(TraitDefinitionIndex):
+
+    def __init__(self, rows):
+        super().__init__(None)
+        self.rows = rows
+
+    def read_rows(self):
+        return self.rows
+
+
+@pytest.fixture
+def index():
+    return Index(ROWS)
+
+
+def keys(entries):
+    return [entry.key for entry in entries]
+
+
+def test_quick_find_cascade(index):
+    assert keys(index.quick_find('MELEE')) == ['Melee']
+    assert keys(index.quick_find('st')) == ['Stamina', 'Strength']
+    assert keys(index.quick_find('arts')) == ['Martial Arts']
+    assert keys(index.quick_find('ar')) == ['Art']
+    assert index.quick_find('nothing') == []
+
+
+def test_find_contains_spans_every_key(index):
+    assert keys(index.find_contains('a')) == ['Abilities', 'Art', 'Attributes', 'Martial Arts', 'Stamina']
+    assert keys(index.find_contains('')) == keys(index.ordered)
+    assert keys(index.find_contains('ti')) == ['Abilities', 'Martial Arts']
+
+
+def test_find_child(index):
+    abilities = index.get(2)
+    assert index.find_child(None, 'att').key == 'Attributes'
+    assert index.find_child(abilities, 'mel').key == 'Melee'
+    # An exact key beats the longer names it prefixes.
+    assert index.find_child(abilities, 'art').key == 'Art'
+    assert index.find_child(abilities, 'swords') is None
+
+
+def test_find_child_reports_ambiguous_prefix(index):
+    with pytest.raises(ValueError, match='Abilities, Attributes'):
+        index.find_child(None, 'a')
+    with pytest.raises(ValueError, match='Martial Arts'):
+        index.find_child(index.get(2), 'm')
+
+
+def test_find_path(index):
+    assert index.find_path('attributes/ STRENGTH').id == 3
+    assert index.find_path('Abilities/Martial Arts').id == 6
+    assert index.find_path('Abilities/Mart') is None
+    assert index.find_path('Attributes/Melee') is None
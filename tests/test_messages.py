@@ -0,0 +1,40 @@
+import pytest
+
+pytest.importorskip('evennia')
+pytest.importorskip('django')
+
+from athanor_storyteller import messages as smsg
+
+
+class Recipient(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.received = list()
+
+    def __str__(self):
+        return self.name
+
+    def msg(self, text):
+        self.received.append(text)
+
+
+class Note(smsg.StorytellerMessage):
+    enactor_message = "You poked {target}."
+    summary_message = "{enactor} poked {count} times at {target}."
+
+
+def test_send_delivers_immediately():
+    enactor = Recipient('Alice')
+    Note({'enactor': enactor, 'target': 'Bob'}).send()
+    assert enactor.received == ["You poked Bob."]
+
+
+def test_send_inside_collect_is_batched():
+    enactor = Recipient('Alice')
+    with smsg.collect():
+        Note({'enactor': enactor, 'target': 'Bob'}, n=1).send()
+        Note({'enactor': enactor, 'target': 'Bob'}, n=2).send()
+        Note({'enactor': enactor, 'target': 'Bob'}, n=2).send()
+        assert enactor.received == list()
+    assert enactor.received == ["Alice poked 2 times at Bob."]